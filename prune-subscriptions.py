@@ -0,0 +1,7 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Removes deleted series and talks from users' favorites; run hourly by configfiles/prune-subscriptions-BRANCH
+from seminars.app import app
+from seminars.users.pwdmanager import prune_all_subscriptions
+with app.app_context():
+    prune_all_subscriptions()
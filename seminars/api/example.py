@@ -19,6 +19,18 @@ def lookup_talk():
         props = J["properties"]
         print("%s occurred at %s" % (props["title"], props["start_time"]))
 
+def lookup_bulk():
+    from requests import post
+    url = "https://researchseminars.org/api/0/lookup/bulk"
+    payload = {"series_ids": ["MITNT", "LATeN"],
+               "talks": [["MathOnlineHostingEvents", 1]]}
+    r = post(url, json=payload)
+    if r.status_code == 200:
+        J = r.json()
+        for series_id, series in J["series"].items():
+            if series is not None:
+                print("There are %s talks in the %s" % (len(series["talks"]), series["properties"]["name"]))
+
 def search_series_get():
     from requests import get
     # Note that America/Los_Angeles is considered different than US/Pacific
@@ -175,6 +187,41 @@ def search_talks_query_language():
         results = J["results"]
         print("There are %s p-adic number theory talks" % len(results))
 
+def search_talks_paged():
+    from requests import post
+    url = "https://researchseminars.org/api/0/search/talks"
+    payload = {"query": {"topics": {"$contains": "math_NT"}},
+               "projection": ["title", "speaker"],
+               "limit": 100}
+    titles = []
+    while True:
+        r = post(url, json=payload)
+        if r.status_code != 200:
+            break
+        J = r.json()
+        titles.extend(rec["title"] for rec in J["results"])
+        if J["next"] is None:
+            break
+        payload["cursor"] = J["next"]
+    print("Fetched %s number theory talk titles" % len(titles))
+
+def sync_changes():
+    from requests import get
+    url = "https://researchseminars.org/api/0/changes"
+    since = 0 # store the value of next between runs
+    while True:
+        r = get(url, params={"since": since})
+        if r.status_code != 200:
+            break
+        J = r.json()
+        for series in J["series"]:
+            print("Series %s changed" % series["shortname"])
+        for talk in J["talks"]:
+            print("Talk %s/%s changed" % (talk["seminar_id"], talk["seminar_ctr"]))
+        since = J["next"]
+        if not J["more"]:
+            break
+
 def topics():
     from requests import get
     url = "https://researchseminars.org/api/0/topics"
@@ -1,26 +1,41 @@
-from flask import jsonify, request, render_template, redirect, url_for, make_response, current_app, Response
+from flask import jsonify, request, render_template, redirect, url_for, make_response, current_app, Response, stream_with_context, g
 from flask_login import current_user
 from seminars import db
 from seminars.app import app
 from seminars.api import api_page
-from seminars.seminar import WebSeminar, seminars_lookup, seminars_search
-from seminars.talk import WebTalk, talks_lookup, talks_search
+from seminars.seminar import WebSeminar, seminars_lookup, seminars_search, searchable_series, all_seminars
+from seminars.talk import WebTalk, talks_lookup, talks_max, talks_search, save_talks
 from seminars.users.pwdmanager import SeminarsUser, ilike_query
 from seminars.users.main import creator_required
 from seminars.utils import (
+    adapt_datetime,
     allowed_shortname,
     short_weekdays,
     process_user_input,
     sanitized_table,
+    whitelisted_cols,
+    changed_since,
+    changes_until,
+    refresh_current,
     APIError,
     MAX_SLOTS,
     MAX_ORGANIZERS,
 )
 from seminars.create.main import process_save_seminar, process_save_talk
+from seminars.api.ratelimit import limiter
 from functools import wraps
+from psycodict.utils import DelayCommit
+from seminars.cache import bump_generation, table_generations, LRUCache
 
+import base64
+import hashlib
+import hmac
 import inspect
 import json
+import pytz
+from datetime import datetime, timedelta
+from dateutil.parser import parse as parse_time
+from time import monotonic
 from pygments import highlight
 from pygments.lexers import PythonLexer
 from pygments.formatters import HtmlFormatter
@@ -65,6 +80,217 @@ def str_jsonify(result, callback=False):
         return Response(json.dumps(result, default=str), mimetype="application/json")
 
 
+def ndjson_stream(header, records):
+    """
+    Streams newline delimited JSON: first ``header``, then one line for each of ``records``.
+
+    Records are serialized as they are produced, so a lazy search (which reads from a server side cursor)
+    is never held in memory.  The records are closed when the response ends, even if the client disconnects early.
+    """
+    def generate():
+        try:
+            yield json.dumps(header, default=str) + "\n"
+            for rec in records:
+                yield json.dumps(rec, default=str) + "\n"
+        finally:
+            close = getattr(records, "close", None)
+            if close is not None:
+                close()
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+def _get_stream(raw_data):
+    # Pops the output format from the request data; returns whether the response should be streamed
+    fmt = raw_data.pop("format", "json")
+    if fmt not in ["json", "ndjson"]:
+        raise APIError({"code": "invalid_format",
+                        "description": "format must be json or ndjson"})
+    return fmt == "ndjson"
+
+
+# The columns determining the order used for paging with cursors
+series_keys = ["shortname"]
+talk_keys = ["start_time", "seminar_id", "seminar_ctr"]
+# Keys of a search request other than the query
+search_options = ["callback", "format", "limit", "offset", "cursor", "projection", "sort"]
+
+
+def encode_cursor(rec, keys):
+    """
+    An opaque string recording the position of a record in the order given by ``keys``
+    """
+    values = json.dumps([rec[key] for key in keys], default=str)
+    return base64.urlsafe_b64encode(values.encode("utf-8")).decode("ascii")
+
+
+def parse_cursor(cursor, keys, table):
+    """
+    A query selecting the records strictly after the position recorded by ``cursor``
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+        if not isinstance(values, list) or len(values) != len(keys):
+            raise ValueError
+        values = [datetime.fromisoformat(val) if table.col_type[key] == "timestamp with time zone" else val
+                  for key, val in zip(keys, values)]
+    except (ValueError, TypeError, UnicodeError):
+        raise APIError({"code": "invalid_cursor",
+                        "description": "cursor must be a value returned as next by an earlier search"})
+    clauses = []
+    for i, key in enumerate(keys):
+        clause = dict(zip(keys[:i], values[:i]))
+        clause[key] = {"$gt": values[i]}
+        clauses.append(clause)
+    return {"$or": clauses}
+
+
+def _get_projection(raw_data, table, keys):
+    # Pops the projection from the request data, returning a list of columns of the (sanitized) table.
+    # The keys used for paging are always included, so that the next cursor can be computed.
+    projection = raw_data.pop("projection", 1)
+    if projection == 1:
+        return list(table.search_cols)
+    if isinstance(projection, str):
+        projection = [projection]
+    if not (isinstance(projection, list) and all(col in table.search_cols for col in projection)):
+        raise APIError({"code": "invalid_projection",
+                        "description": "projection must be 1 or a list of columns from the schema"})
+    return keys + [col for col in projection if col not in keys]
+
+
+def _search_response(search, table, keys, query, raw_data, **kwds):
+    """
+    Runs a search for the v0 API and formats the response.
+
+    If a limit is given and no sort is specified, results are sorted by ``keys``
+    and the response includes a cursor ``next`` for fetching the following page.
+
+    INPUT:
+
+    - ``search`` -- ``seminars_search`` or ``talks_search``
+    - ``table`` -- the sanitized table, determining the columns that may be projected
+    - ``keys`` -- the columns giving the paging order
+    - ``query`` -- the query dictionary
+    - ``raw_data`` -- the remaining request data, containing only keys from ``search_options``
+    """
+    callback = raw_data.pop("callback", False)
+    stream = _get_stream(raw_data)
+    limit, offset = _get_paging(raw_data)
+    projection = _get_projection(raw_data, table, keys)
+    cursor = raw_data.pop("cursor", None)
+    sort = raw_data.pop("sort", None)
+    if raw_data:
+        raise APIError({"code": "extra_keys",
+                        "description": "Unrecognized keys",
+                        "errors": sorted(raw_data)})
+    paged = limit is not None and sort is None
+    if cursor is not None:
+        if not paged:
+            raise APIError({"code": "invalid_cursor",
+                            "description": "cursor requires a limit and the default sort"})
+        query = {"$and": [query, parse_cursor(cursor, keys, table)]}
+    if paged:
+        sort = keys
+        # We fetch one extra result to determine whether there is a next page
+        limit += 1
+    try:
+        results = search(query, projection, objects=False, limit=limit, offset=offset, sort=sort,
+                         lazy=stream and not paged, **kwds)
+    except Exception as err:
+        raise APIError({"code": "search_error",
+                        "description": "error in executing search",
+                        "error": str(err)})
+    ans = {"code": "success"}
+    if paged:
+        if len(results) == limit:
+            results = results[:-1]
+            ans["next"] = encode_cursor(results[-1], keys)
+        else:
+            ans["next"] = None
+    if stream:
+        return ndjson_stream(ans, results)
+    ans["results"] = results
+    return str_jsonify(ans, callback)
+
+
+def _get_paging(raw_data):
+    # Pops limit and offset from the request data, so that they can be applied in the database query
+    limit = raw_data.pop("limit", None)
+    offset = raw_data.pop("offset", 0)
+    if not (limit is None or isinstance(limit, int) and limit > 0):
+        raise APIError({"code": "invalid_limit",
+                        "description": "limit must be a positive integer"})
+    if not (isinstance(offset, int) and offset >= 0):
+        raise APIError({"code": "invalid_offset",
+                        "description": "offset must be a nonnegative integer"})
+    return limit, offset
+
+
+def _get_timezone(raw_data, default="UTC"):
+    # The time zone used for interpreting dates in the request and for the times in the response
+    name = raw_data.get("timezone") or default or "UTC"
+    try:
+        return pytz.timezone(name)
+    except pytz.UnknownTimeZoneError:
+        raise APIError({"code": "invalid_timezone",
+                        "description": "Unknown time zone %s" % name})
+
+
+def _get_daterange(raw_data, tz):
+    """
+    A query restricting talks to the daterange specified in the request data, which can be
+    "past", "future", a single date or a list [start, end] of dates (either of which may be null).
+    Dates are interpreted in the time zone ``tz`` and both endpoints are included.
+    """
+    daterange = raw_data.get("daterange")
+    now = datetime.now(pytz.UTC)
+    if daterange is None:
+        return {}
+    elif daterange == "past":
+        return {"start_time": {"$lte": now}}
+    elif daterange == "future":
+        return {"end_time": {"$gte": now}}
+    if isinstance(daterange, str):
+        daterange = [daterange, daterange]
+    if not (isinstance(daterange, list) and len(daterange) == 2 and
+            all(date is None or isinstance(date, str) for date in daterange)):
+        raise APIError({"code": "invalid_daterange",
+                        "description": 'daterange must be "past", "future", a date or a list [start, end] of dates'})
+    start, end = daterange
+    sub_query = {}
+    try:
+        if start:
+            sub_query["$gte"] = tz.localize(datetime.combine(parse_time(start).date(), datetime.min.time()))
+        if end:
+            sub_query["$lt"] = tz.localize(datetime.combine(parse_time(end).date() + timedelta(days=1), datetime.min.time()))
+    except (ValueError, OverflowError) as err:
+        raise APIError({"code": "invalid_daterange",
+                        "description": "could not parse daterange",
+                        "error": str(err)})
+    return {"start_time": sub_query} if sub_query else {}
+
+
+def _get_sort(raw_data, table, default):
+    # A sort is a list of columns, each optionally prefixed by - for descending order
+    sort = raw_data.get("sort")
+    if sort is None:
+        return default
+    if isinstance(sort, str):
+        sort = [sort]
+    if not (isinstance(sort, list) and all(isinstance(col, str) and col.lstrip("-") in table.search_cols for col in sort)):
+        raise APIError({"code": "invalid_sort",
+                        "description": "sort must be a list of columns, optionally prefixed by - for descending order"})
+    return [(col[1:], -1) if col.startswith("-") else col for col in sort]
+
+
+def _adapt_times(rec, tz):
+    # Converts the times of a talk record into the time zone tz
+    for col in ["start_time", "end_time"]:
+        if rec.get(col) is not None:
+            rec[col] = adapt_datetime(rec[col], tz)
+    return rec
+
+
 def _get_col(col, raw_data, activity):
     val = raw_data.get(col)
     if val is None:
@@ -73,6 +299,55 @@ def _get_col(col, raw_data, activity):
     return val
 
 
+# Users authenticated by the API, keyed on email and a digest of the token; see api_user
+api_user_cache = LRUCache(1000)
+# Number of seconds for which an authenticated user is reused (changes to the users table invalidate them sooner)
+API_USER_TTL = 60
+
+def api_user(auth):
+    """
+    Returns the user identified by an authorization header, raising an APIError if it isn't valid.
+
+    Successful authentications are cached for a short time, so that repeated API calls
+    don't each load the user from the database.  The outcome, including failure, is also
+    remembered for the rest of the request, since both the rate limiter and the
+    authentication check need it.
+    """
+    hit = g.get("api_user")
+    if hit is None or hit[0] != auth:
+        try:
+            hit = (auth, _api_user(auth), None)
+        except APIError as err:
+            hit = (auth, None, err)
+        g.api_user = hit
+    if hit[2] is not None:
+        raise hit[2]
+    return hit[1]
+
+def _api_user(auth):
+    pieces = auth.split()
+    if len(pieces) != 2:
+        raise APIError({"code": "invalid_header",
+                        "description": "Authorization header must have length 2"}, 401)
+    email, token = pieces
+    key = (email.lower(), hashlib.sha256(token.encode("utf-8")).digest())
+    generations = table_generations()
+    # Without generations we can't notice token resets in other processes, so nothing is cached
+    stamp = None if generations is None else generations.get("users", 0)
+    hit = api_user_cache.get(key)
+    if stamp is not None and hit is not None and hit[0] == stamp and monotonic() < hit[1]:
+        return hit[2]
+    user = SeminarsUser(email=email)
+    if user.id is None:
+        raise APIError({"code": "missing_user",
+                        "description": "User %s not found" % email}, 401)
+    if not hmac.compare_digest(token.encode("utf-8"), user.api_token.encode("utf-8")):
+        raise APIError({"code": "invalid_token",
+                        "description": "Token not valid"}, 401)
+    if stamp is not None:
+        api_user_cache.set(key, (stamp, monotonic() + API_USER_TTL, user))
+    return user
+
 def api_auth_required(fn):
     # Note that this wrapper will pass the user as a keyword argument to the wrapped function
     @wraps(fn)
@@ -81,21 +356,8 @@ def api_auth_required(fn):
         if auth is None:
             raise APIError({"code": "missing_authorization",
                             "description": "No authorization header"}, 401)
-        pieces = auth.split()
-        if len(pieces) != 2:
-            raise APIError({"code": "invalid_header",
-                            "description": "Authorization header must have length 2"}, 401)
-        email, token = pieces
-        user = SeminarsUser(email=email)
-        if user.id is None:
-            raise APIError({"code": "missing_user",
-                            "description": "User %s not found" % email}, 401)
-        if token == user.api_token:
-            kwds["user"] = user
-            return fn(*args, **kwds)
-        else:
-            raise APIError({"code": "invalid_token",
-                            "description": "Token not valid"}, 401)
+        kwds["user"] = api_user(auth)
+        return fn(*args, **kwds)
     return inner
 
 def api_auth_optional(fn):
@@ -107,29 +369,69 @@ def api_auth_optional(fn):
         # no auth args
         if auth is None:
             kwds["user"] = None
-            return fn(*args, **kwds)
-
-        pieces = auth.split()
-        if len(pieces) != 2:
-            raise APIError({"code": "invalid_header",
-                            "description": "Authorization header must have length 2"}, 401)
-        email, token = pieces
-        user = SeminarsUser(email=email)
-        if user.id is None:
-            raise APIError({"code": "missing_user",
-                            "description": "User %s not found" % email}, 401)
-        if token == user.api_token:
-            kwds["user"] = user
-            return fn(*args, **kwds)
         else:
-            raise APIError({"code": "invalid_token",
-                            "description": "Token not valid"}, 401)
+            kwds["user"] = api_user(auth)
+        return fn(*args, **kwds)
     return inner
 
+# Responses to anonymous API reads, keyed on the request; see anonymous_cache
+api_response_cache = LRUCache(2000)
+# Number of seconds for which a response is reused (and may be cached by clients);
+# this bounds how stale results depending on the current time (such as upcoming talks) can become
+API_RESPONSE_TTL = 60
+
+def anonymous_cache(*tables):
+    """
+    A decorator for API routes whose response to anonymous callers depends only on the request
+    and on the contents of the given tables.
+
+    Such responses are kept in memory until one of the tables changes or API_RESPONSE_TTL seconds pass,
+    and are sent with Cache-Control, Vary and ETag headers; a request whose If-None-Match header
+    matches the current ETag gets an empty response with status 304.
+
+    Requests with an authorization header or from a logged in user, streamed responses
+    and errors are never cached.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def inner(*args, **kwds):
+            if request.headers.get("authorization") or current_user.is_authenticated:
+                return fn(*args, **kwds)
+            generations = table_generations()
+            if generations is None:
+                return fn(*args, **kwds)
+            stamp = tuple(generations.get(name, 0) for name in tables)
+            # Times in GET searches are interpreted in the browser's time zone
+            key = (request.endpoint, request.method, request.full_path, request.get_data(),
+                   request.cookies.get("browser_timezone"))
+            hit = api_response_cache.get(key)
+            if hit is not None and hit[0] == stamp and monotonic() < hit[1]:
+                body, mimetype, etag = hit[2:]
+            else:
+                response = make_response(fn(*args, **kwds))
+                if response.is_streamed or response.status_code != 200:
+                    return response
+                body, mimetype = response.get_data(), response.mimetype
+                etag = hashlib.sha1(body).hexdigest()
+                api_response_cache.set(key, (stamp, monotonic() + API_RESPONSE_TTL, body, mimetype, etag))
+            if etag in request.if_none_match:
+                response = Response(status=304)
+            else:
+                response = Response(body, mimetype=mimetype)
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "public, max-age=%s" % API_RESPONSE_TTL
+            # Shared caches must not reuse this for logged in users, API callers or other time zones
+            response.vary.update(["Cookie", "Authorization"])
+            return response
+        return inner
+    return decorator
+
 @app.errorhandler(APIError)
 def handle_api_error(err):
     response = jsonify(err.error)
     response.status_code = err.status
+    if err.headers:
+        response.headers.extend(err.headers)
     return response
 
 @api_page.route("/pyhighlight.css")
@@ -182,21 +484,26 @@ def review_api():
     for series_id in seminars_search({"owner": ilike_query(current_user.email)}, "shortname", include_pending=True):
         series.add(series_id)
     series = list(series)
-    if decision == "approve":
-        db.seminars.update({"shortname": {"$in": series}, "by_api": True, "display": False}, {"display": True}, restat=False)
-        db.talks.update({"seminar_id": {"$in": series}, "by_api": True, "display": False}, {"display": True}, restat=False)
-    else:
-        db.seminars.delete({"shortname": {"$in": series}, "by_api": True, "display": False}, restat=False)
-        db.talks.delete({"seminar_id": {"$in": series}, "by_api": True, "display": False}, restat=False)
-        # Need to check whether new seminars might have been completely deleted
-        for series_id in series:
-            if db.seminars.lookup(series_id) is None:
-                db.seminar_organizers.delete({"seminar_id": series_id})
+    with DelayCommit(db):
+        if decision == "approve":
+            db.seminars.update({"shortname": {"$in": series}, "by_api": True, "display": False}, {"display": True}, restat=False)
+            db.talks.update({"seminar_id": {"$in": series}, "by_api": True, "display": False}, {"display": True}, restat=False)
+        else:
+            db.seminars.delete({"shortname": {"$in": series}, "by_api": True, "display": False}, restat=False)
+            db.talks.delete({"seminar_id": {"$in": series}, "by_api": True, "display": False}, restat=False)
+            # Need to check whether new seminars might have been completely deleted
+            for series_id in series:
+                if db.seminars.lookup(series_id) is None:
+                    db.seminar_organizers.delete({"seminar_id": series_id})
+            bump_generation("seminar_organizers")
+        refresh_current(db.seminars, {"shortname": {"$in": series}})
+        refresh_current(db.talks, {"seminar_id": {"$in": series}})
 
     return redirect(url_for("create.index"))
 
 # This static route allows access to the topic graph
 @api_page.route("/<int:version>/topics")
+@anonymous_cache("new_topics")
 def topics(version=0):
     if version != 0:
         raise version_error(version)
@@ -206,6 +513,7 @@ def topics(version=0):
 
 # This static route allows access to a list of all institutions
 @api_page.route("/<int:version>/institutions")
+@anonymous_cache("institutions")
 def institutions(version=0):
     if version != 0:
         raise version_error(version)
@@ -214,6 +522,8 @@ def institutions(version=0):
     return jsonify(institutions)
 
 @api_page.route("/<int:version>/lookup/series", methods=["GET", "POST"])
+@limiter.limit("read")
+@anonymous_cache("seminars", "talks")
 @api_auth_optional
 def lookup_series(version=0, user=None):
     if version != 0:
@@ -223,7 +533,7 @@ def lookup_series(version=0, user=None):
     else:
         raw_data = get_request_args_json()
     series_id = _get_col("series_id", raw_data, "looking up a series")
-
+    stream = _get_stream(raw_data)
 
     try:
         if user is None:
@@ -236,16 +546,30 @@ def lookup_series(version=0, user=None):
         raise APIError({"code": "lookup_error",
                         "description": "an error occurred looking up the series",
                         "error": str(err)})
-    talks = list(talks_search({"seminar_id": series_id}, sort=["start_time"], sanitized=sanitized, objects=False))
-    # tz = pytz.timezone(raw_data.get("timezone", result.get("timezone", "UTC")))
-    # TODO: adapt the times, support daterange, sort
-    ans = {"code": "success", "properties": result, "talks": talks}
+    tz = _get_timezone(raw_data, (result or {}).get("timezone"))
+    query = {"seminar_id": series_id}
+    query.update(_get_daterange(raw_data, tz))
+    # The most recent talks come first when looking at the past
+    sort = _get_sort(raw_data, sanitized_table("talks"), [("start_time", -1)] if raw_data.get("daterange") == "past" else ["start_time"])
+    limit, offset = _get_paging(raw_data)
+    try:
+        talks = talks_search(query, sort=sort, limit=limit, offset=offset, sanitized=sanitized, objects=False, lazy=stream)
+    except Exception as err:
+        raise APIError({"code": "lookup_error",
+                        "description": "an error occurred looking up the talks",
+                        "error": str(err)})
+    if stream:
+        # The properties come first, followed by one line per talk
+        return ndjson_stream({"code": "success", "properties": result}, (_adapt_times(rec, tz) for rec in talks))
+    ans = {"code": "success", "properties": result, "talks": [_adapt_times(rec, tz) for rec in talks]}
     callback = raw_data.get("callback", False)
     return str_jsonify(ans, callback)
 
 # There should be a route for looking up your own seminars/talks and seeing all columns
 
 @api_page.route("/<int:version>/lookup/talk", methods=["GET", "POST"])
+@limiter.limit("read")
+@anonymous_cache("seminars", "talks")
 @api_auth_optional
 def lookup_talk(version=0, user=None):
     if version != 0:
@@ -262,24 +586,98 @@ def lookup_talk(version=0, user=None):
         sem = seminars_lookup(series_id)
         sanitized = not sem.user_can_edit(user=user)
     result = talks_lookup(series_id, series_ctr, objects=False, sanitized=sanitized)
+    if result is not None:
+        _adapt_times(result, _get_timezone(raw_data, result.get("timezone")))
     ans = {"code": "success", "properties": result}
     callback = raw_data.get("callback", False)
     return str_jsonify(ans, callback)
-    # tz = pytz.timezone(raw_data.get("timezone", result.get("timezone", "UTC")))
-    # TODO: adapt the times, support daterange
+
+# The maximum number of series plus talks that can be looked up in one call to lookup/bulk
+MAX_BULK_LOOKUP = 200
+
+@api_page.route("/<int:version>/lookup/bulk", methods=["GET", "POST"])
+@limiter.limit("read")
+@anonymous_cache("seminars", "talks")
+@api_auth_optional
+def lookup_bulk(version=0, user=None):
+    """
+    Looks up many series (with their talks) and talks at once, using one query for each table.
+    """
+    if version != 0:
+        raise version_error(version)
+    if request.method == "POST":
+        raw_data = get_request_json()
+    else:
+        raw_data = get_request_args_json()
+    series_ids = raw_data.get("series_ids", [])
+    talk_ids = raw_data.get("talks", [])
+    if not (isinstance(series_ids, list) and all(isinstance(sid, str) for sid in series_ids)):
+        raise APIError({"code": "invalid_series_ids",
+                        "description": "series_ids must be a list of series identifiers"})
+    if not (isinstance(talk_ids, list) and all(isinstance(pair, list) and len(pair) == 2 and
+                                               isinstance(pair[0], str) and isinstance(pair[1], int)
+                                               for pair in talk_ids)):
+        raise APIError({"code": "invalid_talks",
+                        "description": "talks must be a list of pairs [series_id, series_ctr]"})
+    if len(series_ids) + len(talk_ids) > MAX_BULK_LOOKUP:
+        raise APIError({"code": "lookup_too_large",
+                        "description": "You may look up at most %s series and talks at once" % MAX_BULK_LOOKUP})
+    talk_ids = [tuple(pair) for pair in talk_ids]
+
+    # We need the series of the requested talks too, in order to check permissions
+    all_ids = sorted(set(series_ids).union(sid for (sid, ctr) in talk_ids))
+    talk_query = [{"seminar_id": {"$in": series_ids}}] if series_ids else []
+    talk_query.extend({"seminar_id": sid, "seminar_ctr": ctr} for (sid, ctr) in talk_ids)
+    try:
+        seminars = {sem.shortname: sem for sem in seminars_search({"shortname": {"$in": all_ids}})}
+        talks = list(talks_search({"$or": talk_query}, sort=["start_time"], objects=False)) if talk_query else []
+    except Exception as err:
+        raise APIError({"code": "lookup_error",
+                        "description": "an error occurred in the lookup",
+                        "error": str(err)})
+    # Users who can't edit a series only see the sanitized columns of it and its talks
+    editable = set(sid for (sid, sem) in seminars.items() if user is not None and sem.user_can_edit(user=user))
+    def strip(rec, series_id):
+        if series_id in editable:
+            return rec
+        return {col: val for (col, val) in rec.items() if col in whitelisted_cols}
+
+    series_talks = {sid: [] for sid in series_ids}
+    found_talks = {}
+    for rec in talks:
+        key = (rec["seminar_id"], rec["seminar_ctr"])
+        rec = strip(rec, rec["seminar_id"])
+        if key[0] in series_talks:
+            series_talks[key[0]].append(rec)
+        found_talks[key] = rec
+    series = {}
+    for sid in series_ids:
+        sem = seminars.get(sid)
+        if sem is None:
+            series[sid] = None
+        else:
+            props = strip({col: getattr(sem, col, None) for col in db.seminars.search_cols}, sid)
+            series[sid] = {"properties": props, "talks": series_talks[sid]}
+    ans = {"code": "success",
+           "series": series,
+           "talks": [found_talks.get(key) for key in talk_ids]}
+    callback = raw_data.get("callback", False)
+    return str_jsonify(ans, callback)
 
 @api_page.route("/<int:version>/search/series", methods=["GET", "POST"])
+@limiter.limit("read")
+@anonymous_cache("seminars")
 def search_series(version=0):
     if version != 0:
         raise version_error(version)
     if request.method == "POST":
         raw_data = get_request_json()
         query = raw_data.pop("query", {})
-        # FIXME
-        # projection = raw_data.pop("projection", 1)
         tz = raw_data.pop("timezone", "UTC")
     else:
-        query = get_request_args_json()
+        raw_data = get_request_args_json()
+        # Everything other than the search options is a column constraint
+        query = {col: raw_data.pop(col) for col in list(raw_data) if col not in search_options}
         tz = current_user.tz # Is this the right choice?
         for col, val in query.items():
             if col in db.seminars.col_type:
@@ -288,49 +686,116 @@ def search_series(version=0):
                 raise APIError({"code": "unknown_column",
                                 "col": col,
                                 "description": "%s not a column of seminars" % col})
-        raw_data = {}
     query["visibility"] = 2
     # TODO: encode the times....
-    try:
-        results = list(seminars_search(query, objects=False, sanitized=True, **raw_data))
-    except Exception as err:
-        raise APIError({"code": "search_error",
-                        "description": "error in executing search",
-                        "error": str(err)})
-    ans = {"code": "success", "results": results}
-    callback = raw_data.get("callback", False)
-    return str_jsonify(ans, callback)
+    return _search_response(seminars_search, sanitized_table("seminars"), series_keys, query, raw_data, sanitized=True)
 
 @api_page.route("/<int:version>/search/talks", methods=["GET", "POST"])
+@limiter.limit("read")
+@anonymous_cache("seminars", "seminar_organizers", "institutions", "talks")
 def search_talks(version=0):
     if version != 0:
         raise version_error(version)
     if request.method == "POST":
         raw_data = get_request_json()
         query = raw_data.pop("query", {})
-        projection = raw_data.pop("projection", 1)
         # FIXME
         # tz = raw_data.pop("timezone", "UTC")
     else:
-        query = get_request_args_json()
-        projection = 1
-        raw_data = {}
+        raw_data = get_request_args_json()
+        query = {col: raw_data.pop(col) for col in list(raw_data) if col not in search_options}
     query["hidden"] = False
-    visible_series = set(seminars_search({"visibility": 2}, "shortname"))
-    # TODO: Need to check visibility on the seminar
-    try:
-        results = talks_search(query, projection, objects=False, **raw_data)
-    except Exception as err:
-        raise APIError({"code": "search_error",
-                        "description": "error in executing search",
-                        "error": str(err)})
-    results = [rec for rec in results if rec["seminar_id"] in visible_series]
-    ans = {"code": "success", "results": results}
+    # Only talks in public series (visibility 2) are returned; we check this in the query so that limit and offset apply to visible talks
+    visible = {"$in": sorted(shortname for (shortname, seminar) in all_seminars().items() if seminar.visibility == 2)}
+    if "seminar_id" in query:
+        query = {"$and": [query, {"seminar_id": visible}]}
+    else:
+        query["seminar_id"] = visible
+    # Only sanitized columns may be projected, but the search itself needs the full table to check hidden
+    return _search_response(talks_search, sanitized_table("talks"), talk_keys, query, raw_data)
+
+
+
+# The maximum number of changed records returned by a single call to the changes endpoint
+MAX_CHANGES = 1000
+
+@api_page.route("/<int:version>/changes", methods=["GET", "POST"])
+@limiter.limit("read")
+def changes(version=0):
+    """
+    Returns the current versions of series and talks that have changed since an earlier call,
+    so that mirrors can stay in sync without downloading everything.
+    """
+    if version != 0:
+        raise version_error(version)
+    if request.method == "POST":
+        raw_data = get_request_json()
+    else:
+        raw_data = get_request_args_json()
+    since = raw_data.get("since")
+    if not (since is None or isinstance(since, int) and since >= 0):
+        raise APIError({"code": "invalid_since",
+                        "description": "since must be a value returned as next by an earlier call"})
+    since_time = raw_data.get("since_time")
+    if since_time is not None:
+        try:
+            since_time = parse_time(since_time)
+        except (ValueError, OverflowError, TypeError) as err:
+            raise APIError({"code": "invalid_since_time",
+                            "description": "could not parse since_time",
+                            "error": str(err)})
+        if since_time.tzinfo is None:
+            since_time = pytz.UTC.localize(since_time)
+    limit = raw_data.get("limit", MAX_CHANGES)
+    if not (isinstance(limit, int) and 0 < limit <= MAX_CHANGES):
+        raise APIError({"code": "invalid_limit",
+                        "description": "limit must be a positive integer at most %s" % MAX_CHANGES})
+
+    series_cols = sanitized_table("seminars").search_cols + ["published"]
+    talk_cols = sanitized_table("talks").search_cols + ["hidden", "published"]
+    # Both calls must report changes up to the same point, so that next doesn't skip any
+    until = changes_until()
+    series = changed_since(db.seminars, series_cols, since, since_time, limit, until)
+    talks = changed_since(db.talks, talk_cols, since, since_time, limit, until)
+    if series is None or talks is None:
+        raise APIError({"code": "unavailable",
+                        "description": "change tracking is not available"}, 503)
+    # Both tables draw from the same change counter, so we can merge them and cut at the limit;
+    # any table that was itself cut off at the limit only has later changes left.
+    merged = sorted([(changed, "series", rec) for (changed, rec) in series] +
+                    [(changed, "talks", rec) for (changed, rec) in talks], key=lambda x: x[0])
+    more = len(series) == limit or len(talks) == limit
+    merged = merged[:limit]
+    visible_series = set(searchable_series())
+    ans = {"code": "success", "series": [], "talks": []}
+    for changed, kind, rec in merged:
+        # Removals are only reported for series and talks that have been public at some point,
+        # so that the names of private series aren't revealed
+        published = rec.pop("published")
+        if kind == "series":
+            if rec["deleted"] or rec["shortname"] not in visible_series:
+                # Mirrors should remove series that are deleted or no longer public
+                if not published:
+                    continue
+                rec = {"shortname": rec["shortname"], "visible": False}
+            else:
+                rec["visible"] = True
+        else:
+            hidden = rec.pop("hidden", False)
+            if rec["deleted"] or hidden or not rec["display"] or rec["seminar_id"] not in visible_series:
+                if not published:
+                    continue
+                rec = {"seminar_id": rec["seminar_id"], "seminar_ctr": rec["seminar_ctr"], "visible": False}
+            else:
+                rec["visible"] = True
+        ans[kind].append(rec)
+    # Pass next back as since to continue; if there were no changes, the caller keeps its current value
+    ans["next"] = merged[-1][0] if merged else since
+    ans["more"] = more
     callback = raw_data.get("callback", False)
     return str_jsonify(ans, callback)
 
 
-
 @api_page.route("/<int:version>/test")
 @api_auth_required
 def test_api(version, user):
@@ -338,6 +803,7 @@ def test_api(version, user):
     return response
 
 @api_page.route("/<int:version>/save/series/", methods=["POST"])
+@limiter.limit("write")
 @api_auth_required
 def save_series(version=0, user=None):
     if version != 0:
@@ -460,6 +926,7 @@ def save_series(version=0, user=None):
     return response
 
 @api_page.route("/<int:version>/save/talk/", methods=["POST"])
+@limiter.limit("write")
 @api_auth_required
 def save_talk(version=0, user=None):
     if version != 0:
@@ -519,3 +986,95 @@ def save_talk(version=0, user=None):
                             "series_ctr": new_version.seminar_ctr, # FIXME seminar_ctr -> series_ctr
                             "description": "series successfully %s" % edittype})
     return response
+
+# The maximum number of talks that can be saved in one call to save/talks
+MAX_TALK_BATCH = 500
+
+@api_page.route("/<int:version>/save/talks/", methods=["POST"])
+@limiter.limit("write")
+@api_auth_required
+def save_talks_batch(version=0, user=None):
+    """
+    Saves many talks at once.  Either all talks are saved or (if any has errors) none are.
+    """
+    if version != 0:
+        raise version_error(version)
+    raw_data = get_request_json()
+    talks_data = raw_data.get("talks") if isinstance(raw_data, dict) else None
+    if not (isinstance(talks_data, list) and all(isinstance(D, dict) for D in talks_data)):
+        raise APIError({"code": "invalid_json",
+                        "description": "request must contain a list of dictionaries under the key talks"})
+    if len(talks_data) > MAX_TALK_BATCH:
+        raise APIError({"code": "batch_too_large",
+                        "description": "You may save at most %s talks at once" % MAX_TALK_BATCH})
+    # Temporary measure while we rename seminar_id and seminar_ctr
+    talks_data = [dict(D) for D in talks_data]
+    for D in talks_data:
+        D["seminar_id"] = D.pop("series_id", None)
+        D["seminar_ctr"] = D.pop("series_ctr", None)
+
+    # Look up each series and the existing talks once, rather than once per talk
+    series = {}
+    for series_id in set(D["seminar_id"] for D in talks_data):
+        if series_id is None:
+            raise APIError({"code": "unspecified_series_id",
+                            "description": "You must specify series_id when saving a talk"})
+        sem = seminars_lookup(series_id)
+        if sem is None:
+            raise APIError({"code": "no_series",
+                            "description": "The series %s does not exist (or is deleted)" % series_id})
+        if not sem.user_can_edit(user):
+            raise APIError({"code": "unauthorized_user",
+                            "description": "You do not have permission to edit %s." % series_id}, 401)
+        series[series_id] = sem
+    existing = {}
+    next_ctr = {}
+    for series_id, sem in series.items():
+        ctrs = [D["seminar_ctr"] for D in talks_data if D["seminar_id"] == series_id and D["seminar_ctr"] is not None]
+        if ctrs:
+            for talk in talks_search({"seminar_id": series_id, "seminar_ctr": {"$in": ctrs}}, seminar_dict={series_id: sem}):
+                existing[series_id, talk.seminar_ctr] = talk
+        if len(ctrs) < len([D for D in talks_data if D["seminar_id"] == series_id]):
+            curmax = talks_max("seminar_ctr", {"seminar_id": series_id}, include_deleted=True)
+            next_ctr[series_id] = 1 if curmax is None else curmax + 1
+
+    errors = []
+    warnings = []
+    to_save = []
+    results = []
+    for i, D in enumerate(talks_data):
+        series_id, series_ctr = D["seminar_id"], D["seminar_ctr"]
+        if series_ctr is None:
+            talk = WebTalk(series_id, seminar=series[series_id], editing=True)
+        else:
+            talk = existing.get((series_id, series_ctr))
+            if talk is None:
+                errors.append({"index": i, "errors": ["The talk %s/%s does not exist (or is deleted)" % (series_id, series_ctr)]})
+                continue
+        def warn(msg, *args):
+            warnings.append({"index": i, "warning": msg % args})
+        new_version, errmsgs = process_save_talk(talk, D, warn, format_error, format_input_error, incremental_update=True, next_ctr=next_ctr.get(series_id))
+        if new_version is None:
+            errors.append({"index": i, "errors": errmsgs})
+            continue
+        if talk.new:
+            next_ctr[series_id] += 1
+        if talk.new or new_version != talk:
+            # Talks saved by the API are not displayed until user approves
+            new_version.display = False
+            new_version.by_api = True
+            to_save.append(new_version)
+        else:
+            warn("No changes detected")
+        results.append({"series_id": series_id, "series_ctr": new_version.seminar_ctr, "created": talk.new})
+    if errors:
+        raise APIError({"code": "processing_error",
+                        "description": "Error in processing input; no talks were saved",
+                        "errors": errors})
+    save_talks(to_save, user)
+    ans = {"code": "warning" if warnings else "success",
+           "description": "%s talks saved" % len(to_save),
+           "talks": results}
+    if warnings:
+        ans["warnings"] = warnings
+    return jsonify(ans)
@@ -0,0 +1,139 @@
+"""
+Token bucket rate limiting for the API.
+
+Each client (identified by its user once its API token has been verified, or otherwise by its IP address)
+has a bucket for each class of endpoint.  Buckets refill at a fixed rate up to a maximum size,
+and each request removes one token; requests finding an empty bucket are rejected with status 429.
+
+Buckets are stored in memory by default, so each process limits separately.  To share limits between
+processes, assign ``limiter.backend`` an object with a ``take`` method behaving like ``MemoryBackend.take``.
+"""
+from functools import wraps
+from math import ceil
+from threading import Lock
+from time import monotonic
+from flask import request, make_response
+from seminars.utils import APIError
+
+# Addresses of reverse proxies whose X-Forwarded-For header is trusted; in production
+# Apache forwards every request from localhost (see configfiles/apache.conf)
+TRUSTED_PROXIES = ("127.0.0.1", "::1")
+
+# For each class of endpoint, a pair (tokens added per second, bucket size)
+RATE_LIMITS = {
+    "read": (5, 100),
+    "write": (0.5, 30),
+}
+
+
+class MemoryBackend(object):
+    """
+    Stores buckets in a dictionary local to this process.
+    """
+    # Once there are this many buckets, full ones are discarded (they're equivalent to missing ones)
+    max_buckets = 100000
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = Lock()
+
+    def take(self, key, rate, capacity):
+        """
+        Tries to remove a token from the bucket with the given key.
+
+        INPUT:
+
+        - ``key`` -- a string identifying the bucket
+        - ``rate`` -- the number of tokens added per second
+        - ``capacity`` -- the maximum number of tokens in the bucket (a new bucket starts full)
+
+        OUTPUT:
+
+        A triple (allowed, remaining, wait), where ``allowed`` is whether a token was removed,
+        ``remaining`` is the number of whole tokens left, and ``wait`` is the number of seconds
+        until the next token is available.
+        """
+        now = monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - last) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_buckets:
+                self._prune(now, rate, capacity)
+        wait = 0 if tokens >= 1 else (1 - tokens) / rate
+        return allowed, int(tokens), wait
+
+    def _prune(self, now, rate, capacity):
+        for key, (tokens, last) in list(self._buckets.items()):
+            if tokens + (now - last) * rate >= capacity:
+                del self._buckets[key]
+
+
+class RateLimiter(object):
+    def __init__(self, limits, backend=None):
+        self.limits = limits
+        self.backend = MemoryBackend() if backend is None else backend
+
+    def client_ip(self):
+        """
+        The IP address of the client, looking through a trusted reverse proxy.
+        """
+        addr = request.remote_addr
+        if addr in TRUSTED_PROXIES:
+            forwarded = request.headers.get("X-Forwarded-For")
+            if forwarded:
+                # The proxy appends the address it received the request from; earlier entries come from the client
+                return forwarded.split(",")[-1].strip()
+        return addr
+
+    def client_key(self):
+        """
+        Identifies the client making the current request: by user if it sends a valid API token, otherwise by IP address.
+
+        Requests with invalid tokens count against their IP address, so that varying the token doesn't give a fresh bucket.
+        The user (or the failure) is remembered by api_user, so authentication doesn't look it up again.
+        """
+        auth = request.headers.get("authorization")
+        if auth:
+            from seminars.api.main import api_user  # avoiding circular import
+            try:
+                return "user:%s" % api_user(auth).id
+            except APIError:
+                # The request will be rejected by the authentication check
+                pass
+        return "ip:%s" % self.client_ip()
+
+    def limit(self, kind):
+        """
+        A decorator for API routes, limiting them according to ``self.limits[kind]``.
+
+        Responses include X-RateLimit-Limit, X-RateLimit-Remaining and X-RateLimit-Reset headers;
+        rejected requests get an APIError with status 429 and a Retry-After header.
+        """
+        rate, capacity = self.limits[kind]
+
+        def decorator(fn):
+            @wraps(fn)
+            def inner(*args, **kwds):
+                allowed, remaining, wait = self.backend.take("%s:%s" % (kind, self.client_key()), rate, capacity)
+                headers = {
+                    "X-RateLimit-Limit": str(capacity),
+                    "X-RateLimit-Remaining": str(remaining),
+                    "X-RateLimit-Reset": str(int(ceil(wait))),
+                }
+                if not allowed:
+                    headers["Retry-After"] = str(int(ceil(wait)))
+                    raise APIError({"code": "rate_limited",
+                                    "description": "Too many requests; retry after %s seconds" % int(ceil(wait))},
+                                   429, headers=headers)
+                response = make_response(fn(*args, **kwds))
+                response.headers.extend(headers)
+                return response
+            return inner
+        return decorator
+
+
+limiter = RateLimiter(RATE_LIMITS)
@@ -0,0 +1,120 @@
+"""
+Process-wide caches for data that is expensive to rebuild on every request.
+
+Code that modifies a table calls bump_generation; cached values record the generations
+of the tables they were built from and are rebuilt once any of them changes.  Since the
+generations are stored in the database, this works across processes.
+"""
+from collections import OrderedDict
+from threading import Lock, RLock
+from time import monotonic
+from psycopg2.sql import SQL
+from seminars import db
+
+
+_generations_found = False
+
+
+def _generations_exist():
+    global _generations_found
+    # Once the table exists it stays, so only a negative answer needs to be checked again;
+    # processes started before create_generations_table start bumping as soon as it is created
+    if not _generations_found:
+        cur = db._execute(SQL("SELECT to_regclass(%s)"), ["table_generations"])
+        _generations_found = cur.fetchone()[0] is not None
+    return _generations_found
+
+
+def create_generations_table():
+    db._execute(
+        SQL("CREATE TABLE IF NOT EXISTS table_generations (name text PRIMARY KEY, generation bigint NOT NULL)")
+    )
+
+
+def bump_generation(*names):
+    """
+    Records that the given tables have been modified.  Call this inside the same DelayCommit as the modification.
+    """
+    if _generations_exist():
+        for name in names:
+            db._execute(
+                SQL(
+                    "INSERT INTO table_generations (name, generation) VALUES (%s, 1) "
+                    "ON CONFLICT (name) DO UPDATE SET generation = table_generations.generation + 1"
+                ),
+                [name],
+            )
+
+
+def table_generations():
+    """
+    A dictionary giving the generation of each table, or None if generations aren't being tracked.
+    """
+    if _generations_exist():
+        return dict(db._execute(SQL("SELECT name, generation FROM table_generations")))
+
+
+_cache = {}
+_cache_lock = RLock()
+
+
+def cached(key, tables, build, max_age=None):
+    """
+    Returns ``build()``, reusing the value from an earlier call as long as none of ``tables`` has changed since.
+
+    Values are shared between requests, so callers must not modify them.
+
+    INPUT:
+
+    - ``key`` -- a hashable identifying the cached value
+    - ``tables`` -- a list of table names the value depends on
+    - ``build`` -- a function of no arguments computing the value
+    - ``max_age`` -- if set, the value is also rebuilt after this many seconds (for values that depend on the current time)
+    """
+    generations = table_generations()
+    if generations is None:
+        return build()
+    stamp = tuple(generations.get(name, 0) for name in tables)
+
+    def valid(hit):
+        return hit is not None and hit[0] == stamp and (max_age is None or monotonic() - hit[2] < max_age)
+
+    hit = _cache.get(key)
+    if valid(hit):
+        return hit[1]
+    # Only one thread rebuilds; the others wait for its result
+    with _cache_lock:
+        hit = _cache.get(key)
+        if valid(hit):
+            return hit[1]
+        value = build()
+        _cache[key] = (stamp, value, monotonic())
+    return value
+
+
+class LRUCache(object):
+    """
+    A thread safe dictionary holding at most ``maxsize`` entries, discarding the least recently used ones.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
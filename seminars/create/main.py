@@ -29,6 +29,7 @@ from seminars.utils import (
     APIError,
     tba_like,
     flash_infomsg,
+    refresh_current,
 )
 from seminars.seminar import (
     WebSeminar,
@@ -48,6 +49,7 @@ from seminars.talk import (
     talks_lucky,
     talks_max,
     talks_search,
+    save_talks,
 )
 from seminars.institution import (
     WebInstitution,
@@ -59,9 +61,10 @@ from seminars.institution import (
 )
 from seminars.language import languages
 from seminars.lock import get_lock
+from seminars.cache import bump_generation
 from seminars.users.pwdmanager import ilike_query, ilike_escape, userdb
 from seminars.utils import flash_error
-from psycodict.utils import IdentifierWrapper
+from psycodict.utils import DelayCommit, IdentifierWrapper
 from psycopg2.sql import SQL
 from datetime import datetime, timedelta
 from math import ceil
@@ -313,8 +316,11 @@ def revive_seminar(shortname):
     if not seminar.deleted:
         flash_error("%s %s does not need to be revived, it is not marked as deleted.", seminar.series_type.capitalize(), shortname)
     else:
-        db.seminars.update({"shortname": shortname}, {"deleted": False})
-        db.talks.update({"seminar_id": shortname, "deleted_with_seminar":True}, {"deleted": False})
+        with DelayCommit(db):
+            db.seminars.update({"shortname": shortname}, {"deleted": False})
+            db.talks.update({"seminar_id": shortname, "deleted_with_seminar":True}, {"deleted": False})
+            refresh_current(db.seminars, {"shortname": shortname})
+            refresh_current(db.talks, {"seminar_id": shortname})
         flash(
             "%s %s revived.  Note that any users who were subscribed no longer are."
             % (seminar.series_type, shortname)
@@ -333,9 +339,13 @@ def permdelete_seminar(shortname):
     if not current_user.is_subject_admin(seminar) and seminar.owner != current_user.email:
         flash_error("Only the owner of the %s %s can permanently delete it.", seminar.series_type, shortname)
         return redirect(url_for(".index"), 302)
-    db.seminars.delete({"shortname": shortname})
-    db.seminar_organizers.delete({"seminar_id": shortname})
-    db.talks.delete({"seminar_id": shortname})
+    with DelayCommit(db):
+        db.seminars.delete({"shortname": shortname})
+        db.seminar_organizers.delete({"seminar_id": shortname})
+        db.talks.delete({"seminar_id": shortname})
+        bump_generation("seminar_organizers")
+        refresh_current(db.seminars, {"shortname": shortname})
+        refresh_current(db.talks, {"seminar_id": shortname})
     flash("%s %s deleted." % (seminar.series_type, shortname))
     return redirect(url_for(".index"), 302)
 
@@ -410,7 +420,9 @@ def revive_talk(seminar_id, seminar_ctr):
         flash_error("Talk %s/%s does not need to be revived; it is not marked as deleted.", seminar_id, seminar_ctr)
         return redirect(url_for(".edit_talk", seminar_id=seminar_id, seminar_ctr=seminar_ctr), 302)
     else:
-        db.talks.update({"seminar_id": seminar_id, "seminar_ctr": seminar_ctr}, {"deleted": False})
+        with DelayCommit(db):
+            db.talks.update({"seminar_id": seminar_id, "seminar_ctr": seminar_ctr}, {"deleted": False})
+            refresh_current(db.talks, {"seminar_id": seminar_id, "seminar_ctr": seminar_ctr})
         flash("Talk revived.  Note that any users who were subscribed no longer are.")
         return redirect(url_for(".edit_talk", seminar_id=seminar_id, seminar_ctr=seminar_ctr), 302)
 
@@ -427,7 +439,9 @@ def permdelete_talk(seminar_id, seminar_ctr):
         flash_error("You do not have permission to permanently delete this talk.")
         return redirect(url_for(".index"), 302)
     else:
-        db.talks.delete({"seminar_id": seminar_id, "seminar_ctr": seminar_ctr})
+        with DelayCommit(db):
+            db.talks.delete({"seminar_id": seminar_id, "seminar_ctr": seminar_ctr})
+            refresh_current(db.talks, {"seminar_id": seminar_id, "seminar_ctr": seminar_ctr})
         flash("Talk %s/%s has been permanently deleted." % (seminar_id, seminar_ctr))
         return redirect(url_for(".edit_seminar_schedule", shortname=seminar_id), 302)
 
@@ -851,7 +865,9 @@ def save_talk():
                 talk.seminar_ctr = -talk.seminar_ctr
                 talk.save()
             else:
-                db.talks.delete({"seminar_id": talk.seminar_id, "seminar_ctr": -talk.seminar_ctr})
+                with DelayCommit(db):
+                    db.talks.delete({"seminar_id": talk.seminar_id, "seminar_ctr": -talk.seminar_ctr})
+                    refresh_current(db.talks, {"seminar_id": talk.seminar_id, "seminar_ctr": -talk.seminar_ctr})
         new_version.save()
         if talk.new:
             flash("Talk successfully created!")
@@ -864,14 +880,17 @@ def save_talk():
         edit_kwds.pop("token", None)
     return redirect(url_for(".edit_talk", **edit_kwds), 302)
 
-def process_save_talk(talk, raw_data, warn=flash_warnmsg, format_error=format_errmsg, format_input_error=format_input_errmsg, incremental_update=True):
+def process_save_talk(talk, raw_data, warn=flash_warnmsg, format_error=format_errmsg, format_input_error=format_input_errmsg, incremental_update=True, next_ctr=None):
+    # When saving several new talks at once, the caller allocates their seminar_ctr values and passes them as next_ctr
     errmsgs = []
     data = {
         "seminar_id": talk.seminar_id,
         "token": talk.token,
         "display": talk.display,  # could be being edited by anonymous user
     }
-    if talk.new:
+    if talk.new and next_ctr is not None:
+        data["seminar_ctr"] = next_ctr
+    elif talk.new:
         curmax = talks_max("seminar_ctr", {"seminar_id": talk.seminar_id}, include_deleted=True)
         if curmax is None:
             curmax = 0
@@ -1183,8 +1202,7 @@ def save_seminar_schedule():
             new_version = WebTalk(talk.seminar_id, data=data)
             to_save.append(new_version) # defer save in case of errors on other talks
 
-    for newver in to_save:
-        newver.save()
+    save_talks(to_save)
 
     if raw_data.get("detailctr"):
         return redirect(url_for(".edit_talk", seminar_id=shortname, seminar_ctr=int(raw_data.get("detailctr")),), 302,)
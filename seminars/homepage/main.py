@@ -1,15 +1,18 @@
 from seminars.app import app
 from seminars import db
-from seminars.talk import talks_search, talks_lucky, talks_lookup, WebTalk
+from seminars.talk import talks_search, talks_lucky, talks_lookup, talks_facets, talks_last_edit, viewer_access_state, WebTalk
+from seminars.cache import cached
 from seminars.utils import (
     Toggle,
     adapt_datetime,
     collapse_ors,
     date_and_daytime_to_time,
     date_and_daytimes_to_times,
+    feed_validators,
     flash_error,
     ics_file,
     maxlength,
+    not_modified,
     process_user_input,
     to_dict,
     topdomain,
@@ -20,7 +23,7 @@ from seminars.language import languages
 from seminars.institution import institutions, WebInstitution
 from seminars.knowls import static_knowl
 from flask import abort, render_template, request, redirect, url_for, Response, make_response
-from seminars.seminar import seminars_search, all_seminars, all_organizers, all_institutions, seminars_lucky, next_talk_sorted, series_sorted, audience_options
+from seminars.seminar import seminars_search, all_seminars, all_organizers, all_institutions, seminars_lucky, seminars_last_edit, next_talk_sorted, series_sorted, audience_options, searchable_series
 from flask_login import current_user
 import json
 from datetime import datetime, timedelta
@@ -411,9 +414,7 @@ def index():
         return redirect(url_for_with_args(subsection+"_index", {'keywords': keywords} if keywords else {}))
     return _talks_index(subsection="talks",
                         limit=default_limit,
-                        asblock=True,
-                        getcounters=True,
-                        fully_filtered=True)
+                        getcounters=True)
 
 
 # we need two functions because of url_for calls
@@ -429,9 +430,33 @@ def talks_index(timestamp, limit):
 def past_talks_index(timestamp, limit):
     return talks_index_main(timestamp, limit, past=True)
 
+EPOCH = pytz.UTC.localize(datetime(1970, 1, 1))
+
+def talk_cursor(talk):
+    """
+    An opaque string recording the position of a talk in the (start_time, seminar_id, seminar_ctr) order used for paging
+    """
+    # The seminar_id comes last since it is the only part that may contain the separator
+    return "%d~%d~%s" % ((talk.start_time - EPOCH) // timedelta(microseconds=1), talk.seminar_ctr, talk.seminar_id)
+
+def parse_talk_cursor(cursor, past=False):
+    """
+    The position recorded by ``cursor``, in the form taken by the ``after`` argument of talks_search:
+    the talks strictly after it (before, if ``past``) are selected
+    """
+    try:
+        start_time, seminar_ctr, seminar_id = cursor.split("~", 2)
+        start_time = EPOCH + timedelta(microseconds=int(start_time))
+        seminar_ctr = int(seminar_ctr)
+    except (ValueError, OverflowError):
+        abort(400, "Invalid cursor")
+    return ["start_time", "seminar_id", "seminar_ctr"], [start_time, seminar_id, seminar_ctr], past
+
 def talks_index_main(timestamp, limit, past=False):
     query = {}
-    if timestamp:
+    cursor = request.args.get("cursor")
+    if timestamp and not cursor:
+        # older links page by timestamp
         query["start_time"] = {"$gt" if not past else "$lt": pytz.UTC.localize(datetime.utcfromtimestamp(timestamp))}
     visible = 0
     if request.args.get("visible"):
@@ -445,15 +470,14 @@ def talks_index_main(timestamp, limit, past=False):
 
     # we might not care about counters, if we are repopulating table
     # but we would like to fill the first page properly before relying on prefill
-    getcounters=timestamp is None
+    getcounters = timestamp is None and not cursor
     return _talks_index(query,
                         subsection="talks" if not past else "past_talks",
                         past=past,
                         limit=limit,
-                        asblock=limit is not None,
                         getcounters=getcounters,
                         visible_counter=visible,
-                        fully_filtered=True)
+                        cursor=cursor)
 
 
 
@@ -494,8 +518,43 @@ def _get_counters(objects):
     langs.sort(key=lambda x: (-language_counts[x[0]], x[1]))
     return {"topic_counts": topic_counts, "language_counts": language_counts}
 
+def _filter_clauses(more):
+    """
+    Translates the filter cookies into a list of queries, to be combined using $and.
+
+    These match the filtering done in _get_row_attributes, so that the database only returns
+    talks that will be shown.
+    """
+    clauses = []
+    if request.cookies.get('filter_topic', '-1') == '1':
+        clauses.append({"topics": {"$overlaps": sorted(topic_dag.expand(topic_dag.filtered_topics()))}})
+    if request.cookies.get('filter_language', '-1') == '1':
+        clauses.append({"language": {"$in": request.cookies.get('languages', '').split(',')}})
+    if request.cookies.get('filter_calendar', '-1') == '1':
+        if current_user.is_anonymous:
+            clauses.append({"seminar_id": {"$in": []}})
+        else:
+            clauses.append({"$or": [{"seminar_id": {"$in": current_user.seminar_subscriptions}}] + current_user.talks_query})
+    if request.cookies.get('filter_more', '-1') == '1' and more:
+        clauses.append(more)
+    return clauses
+
+def _get_talk_counters(query, past=False, cache=True):
+    """
+    The topic and language counts shown in the filter panes of the talks browse pages.
+
+    These are computed by the database, and cached until talks or series change.  Since the
+    division between past and future talks moves with time, they are also refreshed every few minutes.
+    """
+    def build():
+        return {"topic_counts": talks_facets("topics", query, array=True),
+                "language_counts": talks_facets("language", query)}
+    if not cache:
+        return build()
+    return cached(("talk_counters", past, topdomain()), ["talks", "seminars", "seminar_organizers", "institutions"], build, max_age=300)
+
 def _get_row_attributes(objects, visible_counter=0, fully_filtered=False):
-    filtered_topics = topic_dag.filtered_topics()
+    filtered_topics = topic_dag.expand(topic_dag.filtered_topics())
     filter_topic = request.cookies.get('filter_topic', '-1') == '1'
     filtered_languages = set(request.cookies.get('languages', '').split(','))
     filter_language = request.cookies.get('filter_language', '-1') == '1'
@@ -566,11 +625,9 @@ def _talks_index(query={},
                  past=False,
                  keywords="",
                  limit=None, # this is an upper bound on desired number of talks, we might filter some extra out
-                 limitbuffer=1000, # the number of extra talks that we give ourselves to try to get the limit right
-                 asblock=False, # the number of talks returned is based on star time blocks
                  getcounters=True, # doesn't limit the SQL search to get the full counters
                  visible_counter=0,
-                 fully_filtered=True,
+                 cursor=None, # from talk_cursor, the position after which to start
                  ):
     # Eventually want some kind of cutoff on which talks are included.
     search_array = TalkSearchArray(past=past)
@@ -602,70 +659,38 @@ def _talks_index(query={},
         query["end_time"] = {"$lt": now}
         query["seminar_ctr"] = {"$gt": 0} # don't show rescheduled talks
         if sort is None:
-            sort = [("start_time", -1), "seminar_id"]
+            # must match the order used by talk_cursor
+            sort = [("start_time", -1), ("seminar_id", -1), ("seminar_ctr", -1)]
     else:
         query["end_time"] = {"$gte": now}
         if sort is None:
-            sort = ["start_time", "seminar_id"]
+            sort = ["start_time", "seminar_id", "seminar_ctr"]
 
 
-    def dosearch(limit=limit, limitbuffer=limitbuffer):
-        if limit and not getcounters:
-            # we fetch extra talks to account for filtering
-            talks = talks_search(query, sort=sort, seminar_dict=all_seminars(), more=more, limit=limit + limitbuffer)
-        else:
-            talks = talks_search(query, sort=sort, seminar_dict=all_seminars(), more=more)
-        # Filtering on display and hidden isn't sufficient since the seminar could be private
-        talks =  [talk for talk in talks if talk.searchable()]
-        return talks
-
-
-    def truncateasblock(talks, retry=True):
-        if not talks:
-            return talks
-        last_time = None
-        # find enough talks such that the next talk has a different starting time
-        for i, t in enumerate(talks):
-            if last_time is None:
-                last_time = t.start_time
-                continue
-            if t.start_time != last_time:
-                if i > limit:
-                    return talks[:i-1]
-                else:
-                    last_time = t.start_time
-        else:
-            if retry and limit and not getcounters:
-                # redo the search without limits
-                talks = dosearch(limit=None)
-                return truncateasblock(talks, retry=False)
-            return talks
-    def truncate(talks):
-        if asblock and limit:
-            return truncateasblock(talks)
-        elif limit:
-            return talks[:limit]
-        else:
-            return talks
-
-    talks = dosearch()
+    # Filtering on display and hidden isn't sufficient since the seminar could be private
+    query["seminar_id"] = {"$in": searchable_series()}
     if getcounters:
-        counters = _get_counters(talks)
+        # counters are computed before applying the filters from cookies
+        counters = _get_talk_counters(query, past, cache=not keywords)
     else:
         counters = _get_counters([])
+    filters = _filter_clauses(more)
+    seminar_dict = all_seminars()
+    def dosearch(cursor, limit):
+        # Combine with $and, since keywords may add an $or to the query
+        # Combine with $and, since keywords may add an $or to the query
+        search_query = dict(query)
+        if filters:
+            search_query["$and"] = filters
+        after = parse_talk_cursor(cursor, past) if cursor else None
+        talks = talks_search(search_query, sort=sort, seminar_dict=seminar_dict, more=more, limit=limit, after=after)
+        return talks, [talk for talk in talks if talk.searchable()]
 
-    if getcounters and fully_filtered:
-        # the initial query was not limited as getcounters = True
-        # we will first filter after figuring out the more attribute
-        # and then truncate
-        pass
-    else:
-        # we are not going to filter or the query was already limited, so we can truncate
-        talks = truncate(talks)
     # While we may be able to write a query specifying inequalities on the timestamp in the user's timezone, it's not easily supported by talks_search.  So we filter afterward
     timerange = info.get("timerange", "").strip()
+    tz = current_user.tz
+    onetime = None
     if timerange:
-        tz = current_user.tz
         try:
             timerange = process_user_input(timerange, col="search", typ="daytimes")
         except ValueError:
@@ -673,33 +698,43 @@ def _talks_index(query={},
                 onetime = process_user_input(timerange, col="search", typ="daytime")
             except ValueError:
                 flash_error("Invalid time range input: %s", timerange)
-            else:
-                for talk in talks:
-                    if talk.more:
-                        talkstart = adapt_datetime(talk.start_time, tz)
-                        t = date_and_daytime_to_time(talkstart.date(), onetime, tz)
-                        talk.more = (t == talkstart)
-        else:
-            for talk in talks:
-                if talk.more:
-                    talkstart = adapt_datetime(talk.start_time, tz)
+            timerange = None
+    def filter_timerange(talks):
+        for talk in talks:
+            if talk.more:
+                talkstart = adapt_datetime(talk.start_time, tz)
+                if onetime:
+                    t = date_and_daytime_to_time(talkstart.date(), onetime, tz)
+                    talk.more = (t == talkstart)
+                elif timerange:
                     talkend = adapt_datetime(talk.end_time, tz)
                     t0, t1 = date_and_daytimes_to_times(talkstart.date(), timerange, tz)
                     talk.more = (t0 <= talkstart) and (talkend <= t1)
 
-    # get last_time before potential filtering
-    last_time = int(talks[-1].start_time.timestamp()) if talks else None
-    if fully_filtered: # first filter then truncate
-        row_attributes, talks = _get_row_attributes(talks, visible_counter, fully_filtered)
-        if getcounters: # we have not yet truncated the results
-            if limit and len(talks) > limit:
-                talks = truncate(talks)
-                row_attributes = row_attributes[:len(talks)]
-                last_time = int(talks[-1].start_time.timestamp()) if talks else None
-    else:
-        row_attributes = _get_row_attributes(talks, visible_counter)
-
-
+    # We page with a keyset cursor on (start_time, seminar_id, seminar_ctr), fetching limit talks at a time.
+    # The filters from cookies are applied in the database, but the time range and searchable
+    # checks happen here, so we may need a few batches to fill a page; we never use more than max_batches.
+    talks, row_attributes = [], []
+    last_cursor = None
+    max_batches = 5
+    for _ in range(max_batches):
+        found, batch = dosearch(cursor, limit)
+        filter_timerange(batch)
+        attributes, shown = _get_row_attributes(batch, visible_counter, fully_filtered=True)
+        visible_counter += len(shown)
+        talks.extend(shown)
+        row_attributes.extend(attributes)
+        if limit is not None and len(talks) >= limit:
+            talks = talks[:limit]
+            row_attributes = row_attributes[:limit]
+            last_cursor = talk_cursor(talks[-1])
+            break
+        if limit is None or len(found) < limit:
+            # no more talks
+            last_cursor = None
+            break
+        # continue after the last talk examined, whether or not it was shown
+        cursor = last_cursor = talk_cursor(found[-1])
 
     response = make_response(render_template(
         "browse_talks.html",
@@ -709,7 +744,7 @@ def _talks_index(query={},
         subsection=subsection,
         talk_row_attributes=zip(talks, row_attributes),
         past=past,
-        last_time=last_time,
+        cursor=last_cursor,
         extraargs=urlencode({'keywords': keywords}),
         **counters
     ))
@@ -947,21 +982,43 @@ def ics_seminar_file(shortname):
         if seminar is None or not seminar.visible():
             return abort(404, "Seminar not found")
 
+    # Links to livestreams depend on the viewer
+    viewer = viewer_access_state(current_user, [shortname])
+    etag, last_modified = feed_validators(
+        [talks_last_edit(seminar.talks_query), (seminar.edited_at, 1)], viewer
+    )
+    response = not_modified(etag, last_modified)
+    if response is not None:
+        return response
     return ics_file(
-        seminar.talks(),
+        seminar.talks(lazy=True),
         filename="{}.ics".format(shortname),
-        user=current_user)
+        user=current_user,
+        etag=etag,
+        last_modified=last_modified)
 
 
 @app.route("/talk/<seminar_id>/<int:talkid>/ics")
 def ics_talk_file(seminar_id, talkid):
+    stamp = talks_last_edit({"seminar_id": seminar_id, "seminar_ctr": talkid})
+    if stamp[1] == 0:
+        return abort(404, "Talk not found")
+    viewer = viewer_access_state(current_user, [seminar_id])
+    etag, last_modified = feed_validators(
+        [stamp, seminars_last_edit({"shortname": seminar_id})], viewer
+    )
+    response = not_modified(etag, last_modified)
+    if response is not None:
+        return response
     talk = talks_lucky({"seminar_id": seminar_id, "seminar_ctr": talkid})
     if talk is None:
         return abort(404, "Talk not found")
     return ics_file(
         [talk],
         filename="{}_{}.ics".format(seminar_id, talkid),
-        user=current_user)
+        user=current_user,
+        etag=etag,
+        last_modified=last_modified)
 
 
 @app.route("/talk/<seminar_id>/<int:talkid>/")
@@ -2,6 +2,7 @@ from flask import redirect, url_for
 from flask_login import current_user
 from seminars import db
 from seminars.utils import allowed_shortname
+from seminars.cache import bump_generation
 from seminars.users.pwdmanager import userdb
 from seminars.utils import flash_error
 from collections.abc import Iterable
@@ -108,6 +109,7 @@ class WebInstitution(object):
         else:
             assert data.get("shortname")
             db.institutions.upsert({"shortname": self.shortname}, data)
+        bump_generation("institutions")
 
     def admin_link(self):
         rec = userdb.lookup(self.admin)
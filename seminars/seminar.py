@@ -7,9 +7,11 @@ from seminars.utils import (
     allowed_shortname,
     count_distinct,
     format_errmsg,
+    last_edit_distinct,
     lucky_distinct,
     make_links,
     max_distinct,
+    refresh_current,
     search_distinct,
     show_input_errors,
     weekdays,
@@ -19,17 +21,23 @@ from seminars.utils import (
 from .topic import topic_dag
 from .toggle import toggle
 from .utils import flash_error
+from .cache import bump_generation, cached, LRUCache
+from .subscriptions import subscriptions_table_exists, delete_subscriptions
 from psycodict.utils import DelayCommit, IdentifierWrapper
 from markupsafe import Markup
 from psycopg2.sql import SQL
 import pytz
 from collections import defaultdict
+from copy import copy
 from datetime import datetime
 
 import urllib.parse
 
 combine = datetime.combine
 
+# Rendered rows for the browse pages, keyed on the series version and the viewer; see WebSeminar.oneline
+oneline_cache = LRUCache(5000)
+
 access_control_options = [
     (0, 'open'),
     (1, 'time-restricted'),
@@ -300,7 +308,9 @@ class WebSeminar(object):
         data["edited_by"] = int(user.id)
         data["edited_at"] = datetime.now(tz=pytz.UTC)
         self.validate()
-        db.seminars.insert_many([data])
+        with DelayCommit(db):
+            db.seminars.insert_many([data])
+            refresh_current(db.seminars, {"shortname": self.shortname})
 
 
     def save_admin(self):
@@ -308,13 +318,16 @@ class WebSeminar(object):
         data = {col: getattr(self, col, None) for col in db.seminars.search_cols}
         assert data.get("shortname")
         data["edited_by"] = 0
-        db.seminars.insert_many([data])
+        with DelayCommit(db):
+            db.seminars.insert_many([data])
+            refresh_current(db.seminars, {"shortname": self.shortname})
 
     def save_organizers(self):
         # Need to allow for deleting organizers, so we delete them all then add them back
         with DelayCommit(db):
             db.seminar_organizers.delete({"seminar_id": self.shortname})
             db.seminar_organizers.insert_many(self.organizers)
+            bump_generation("seminar_organizers")
 
     # We use timestamps on January 1, 2020 to save start and end times
     # so that we have a well defined conversion between time zone and UTC offset (which
@@ -474,6 +487,38 @@ class WebSeminar(object):
         include_audience=False,
         include_subscribe=True,
         show_attributes=False,
+    ):
+        flags = (conference, include_institutions, include_datetime, include_topics, include_audience, include_subscribe, show_attributes)
+        edited_at = getattr(self, "edited_at", None)
+        if edited_at is None:
+            return self._oneline(*flags)
+        key = (
+            self.shortname,
+            edited_at,
+            self.deleted,
+            self.display,
+            self.visibility,
+            tuple(map(tuple, self.institutions_data)),
+            self.next_talk_time if include_datetime and not conference else None,
+            str(current_user.tz),
+            None if current_user.is_anonymous else self.is_subscribed(),
+            datetime.now(self.tz).year,
+        ) + flags
+        ans = oneline_cache.get(key)
+        if ans is None:
+            ans = self._oneline(*flags)
+            oneline_cache.set(key, ans)
+        return ans
+
+    def _oneline(
+        self,
+        conference=False,
+        include_institutions=True,
+        include_datetime=True,
+        include_topics=False,
+        include_audience=False,
+        include_subscribe=True,
+        show_attributes=False,
     ):
         datetime_tds = ""
         if include_datetime:
@@ -584,13 +629,17 @@ class WebSeminar(object):
         format = "%a %b %-d" if adapt_datetime(date,self.tz).year == datetime.now(self.tz).year else "%d-%b-%Y"
         return adapt_datetime(date, self.tz).strftime(format)
 
-    def talks(self, projection=1):
-        from seminars.talk import talks_search  # avoid import loop
-
+    @property
+    def talks_query(self):
         query = {"seminar_id": self.shortname, "seminar_ctr": {"$gt": 0}, "display": True, "hidden": {"$or": [False, {"$exists": False}]}}
         if self.user_can_edit():
             query.pop("display")
-        return talks_search(query, projection=projection)
+        return query
+
+    def talks(self, projection=1, lazy=False):
+        from seminars.talk import talks_search  # avoid import loop
+
+        return talks_search(self.talks_query, projection=projection, seminar_dict={self.shortname: self}, lazy=lazy)
 
     @property
     def ics_link(self):
@@ -626,26 +675,27 @@ class WebSeminar(object):
             with DelayCommit(db):
                 db.seminars.update({"shortname": self.shortname}, {"deleted": True})
                 db.talks.update({"seminar_id": self.shortname, "deleted": False}, {"deleted": True, "deleted_with_seminar": True})
-                for elt in db.users.search(
-                    {"seminar_subscriptions": {"$contains": self.shortname}},
-                    ["id", "seminar_subscriptions"],
-                ):
-                    elt["seminar_subscriptions"].remove(self.shortname)
-                    db.users.update(
-                        {"id": elt["id"]},
-                        {"seminar_subscriptions": elt["seminar_subscriptions"]}
+                refresh_current(db.seminars, {"shortname": self.shortname})
+                refresh_current(db.talks, {"seminar_id": self.shortname})
+                if subscriptions_table_exists():
+                    delete_subscriptions(seminar_id=self.shortname)
+                else:
+                    # One statement for each column, however many users are subscribed
+                    db._execute(
+                        SQL(
+                            "UPDATE {0} SET seminar_subscriptions = array_remove(seminar_subscriptions, %s) "
+                            "WHERE seminar_subscriptions @> ARRAY[%s]"
+                        ).format(IdentifierWrapper("users")),
+                        [self.shortname, self.shortname],
+                    )
+                    db._execute(
+                        SQL(
+                            "UPDATE {0} SET talk_subscriptions = talk_subscriptions - %s "
+                            "WHERE talk_subscriptions ? %s"
+                        ).format(IdentifierWrapper("users")),
+                        [self.shortname, self.shortname],
                     )
-                for i, talk_sub in db._execute(
-                    SQL("SELECT {},{} FROM {} WHERE {} ? %s").format(
-                        *map(
-                            IdentifierWrapper,
-                            ["id", "talk_subscriptions", "users", "talk_subscriptions"],
-                        )
-                    ),
-                    [self.shortname],
-                ):
-                    del talk_sub[self.shortname]
-                    db.users.update({"id": i}, {"talk_subscriptions": talk_sub})
+                    bump_generation("users")
             self.deleted = True
             return True
         else:
@@ -717,11 +767,20 @@ def _iterator(organizer_dict, institution_dict, objects=True, more=False):
     return object_iterator if objects else db.seminars._search_iterator
 
 
-def seminars_count(query={}, include_deleted=False):
+def seminars_count(query={}, include_deleted=False, include_pending=False):
     """
     Replacement for db.seminars.count to account for versioning.
+
+    Versions awaiting approval are only counted if ``include_pending`` is set, which scans the version history.
+    """
+    return count_distinct(db.seminars, _counter, query, include_deleted, include_pending)
+
+
+def seminars_last_edit(query={}, include_deleted=False):
     """
-    return count_distinct(db.seminars, _counter, query, include_deleted)
+    The most recent edit time among seminars matching ``query``, and their number; see ``feed_validators``.
+    """
+    return last_edit_distinct(db.seminars, _selecter, query, include_deleted)
 
 
 def seminars_max(col, constraint={}, include_deleted=False):
@@ -732,7 +791,7 @@ def seminars_search(*args, **kwds):
     """
     Replacement for db.seminars.search to account for versioning, return WebSeminar objects.
 
-    Doesn't support split_ors or raw.  Always computes count.
+    Doesn't support split_ors or raw.  Computes a count only when info is provided.
     """
     objects = kwds.pop("objects", True)
     col_projection = (len(args) > 1 and isinstance(args[1], str) or "projection" in kwds and isinstance(kwds["projection"], str))
@@ -790,27 +849,53 @@ def all_organizers(query={}):
     """
     A dictionary with keys the seminar ids and values a list of organizer data as fed into WebSeminar.
     Usable for the organizer_dict input to seminars_search, seminars_lucky and seminars_lookup
+
+    The result for the empty query is cached across requests and should not be modified.
     """
-    organizers = defaultdict(list)
-    for rec in db.seminar_organizers.search(query, sort=["seminar_id", "order"]):
-        organizers[rec["seminar_id"]].append(rec)
-    return organizers
+    def build():
+        organizers = defaultdict(list)
+        for rec in db.seminar_organizers.search(query, sort=["seminar_id", "order"]):
+            organizers[rec["seminar_id"]].append(rec)
+        return organizers
+    if query:
+        return build()
+    return cached("all_organizers", ["seminar_organizers"], build)
 
 def all_institutions(query={}):
     """
     A dictionary with keys the seminar ids and values a list of institution data as fed into WebSeminar.
     Usable for the institution_dict input to seminars_search, seminars_lucky and seminars_lookup
+
+    The result for the empty query is cached across requests and should not be modified.
     """
-    return {rec["shortname"]: (rec.get("name"), rec.get("homepage")) for rec in db.institutions.search(query, ["shortname", "name", "homepage"])}
+    def build():
+        return {rec["shortname"]: (rec.get("name"), rec.get("homepage")) for rec in db.institutions.search(query, ["shortname", "name", "homepage"])}
+    if query:
+        return build()
+    return cached("all_institutions", ["institutions"], build)
 
 def all_seminars():
     """
     A dictionary with keys the seminar ids and values a WebSeminar object.
+
+    The result is cached across requests and should not be modified.
     """
-    return {
-        seminar.shortname: seminar
-        for seminar in seminars_search({}, organizer_dict=all_organizers(), institution_dict=all_institutions())
-    }
+    def build():
+        return {
+            seminar.shortname: seminar
+            for seminar in seminars_search({}, organizer_dict=all_organizers(), institution_dict=all_institutions())
+        }
+    return cached("all_seminars", ["seminars", "seminar_organizers", "institutions"], build)
+
+def searchable_series():
+    """
+    A sorted list of the shortnames of series whose talks show up on the browse and search pages.
+
+    The result is cached across requests and should not be modified.
+    """
+    def build():
+        return sorted(shortname for (shortname, seminar) in all_seminars().items() if seminar.searchable())
+    return cached("searchable_series", ["seminars", "seminar_organizers", "institutions"], build)
 
 def next_talks(query=None):
     """
@@ -824,6 +909,7 @@ def next_talks(query=None):
 SELECT DISTINCT ON (seminar_id) {0} FROM
 (SELECT DISTINCT ON (seminar_id, seminar_ctr) {1} FROM {2} ORDER BY seminar_id, seminar_ctr, id DESC) tmp{3}
 """)
+    _current_selecter = SQL("SELECT DISTINCT ON (seminar_id) {0} FROM (SELECT {1} FROM {2}) tmp{3}")
     for rec in search_distinct(
             db.talks,
             _selecter,
@@ -831,7 +917,8 @@ SELECT DISTINCT ON (seminar_id) {0} FROM
             db.talks._search_iterator,
             query,
             projection=["seminar_id", "start_time"],
-            sort=["seminar_id", "start_time"]):
+            sort=["seminar_id", "start_time"],
+            current_selecter=_current_selecter):
         ans[rec["seminar_id"]] = rec["start_time"]
     return ans
 
@@ -839,10 +926,11 @@ def next_talk_sorted(results, reverse=False):
     """
     Sort a list of WebSeminars by when their next talk is (and add the next_talk_time attribute to each seminar).
 
-    Returns the sorted list.
+    Returns the sorted list, containing copies of the seminars so that those shared
+    with other requests (via all_seminars) aren't modified.
     """
-    results = list(results)
     ntdict = next_talks()
+    results = [copy(R) for R in results]
     for R in results:
         R.next_talk_time = ntdict[R.shortname]
     results.sort(key=lambda R: (R.next_talk_time, R.name))
@@ -0,0 +1,182 @@
+"""
+Storage for the series and talks that users have added to their favorites.
+
+Subscriptions used to be stored in the users table, in the columns ``seminar_subscriptions`` (a list of
+series) and ``talk_subscriptions`` (a jsonb dictionary from series to lists of talk counters).  Once the
+``subscriptions`` table has been created with create_subscriptions_table (which also copies the existing
+subscriptions), it is used instead, with one row for each subscribed series (``seminar_ctr`` null) or talk.
+
+Whether the table exists is checked when subscriptions are accessed rather than when the process starts,
+so running processes switch to it as soon as it is created.  For the same reason we query it with SQL
+rather than through ``db.subscriptions``, which is only available in processes started after its creation.
+"""
+from collections import defaultdict
+from psycopg2.sql import SQL
+from psycodict.utils import DelayCommit, IdentifierWrapper
+from seminars import db
+
+_table_exists = False
+
+
+def subscriptions_table_exists():
+    global _table_exists
+    # Once the table exists it stays, so only a negative answer needs to be checked again
+    if not _table_exists:
+        cur = db._execute(SQL("SELECT to_regclass(%s)"), ["subscriptions"])
+        _table_exists = cur.fetchone()[0] is not None
+    return _table_exists
+
+
+def create_subscriptions_table():
+    """
+    Creates the subscriptions table, with indexes for looking up subscriptions by user and by series or talk,
+    and fills it from the users table with migrate_subscriptions.
+    """
+    with DelayCommit(db):
+        db.create_table(
+            "subscriptions",
+            {"bigint": ["user_id"], "text": ["seminar_id"], "integer": ["seminar_ctr"]},
+            label_col=None,
+            table_description="Series and talks that users have added to their favorites",
+            col_description={
+                "user_id": "users.id of the subscriber",
+                "seminar_id": "seminars.shortname of the series",
+                "seminar_ctr": "seminar_ctr of the talk, or null for a subscription to the whole series",
+            },
+            sort=None,
+            id_ordered=False,
+        )
+        # Talk counters are positive, so 0 stands in for null: each user has at most one subscription to a series or talk
+        db._execute(SQL(
+            "CREATE UNIQUE INDEX subscriptions_user_unique ON subscriptions (user_id, seminar_id, COALESCE(seminar_ctr, 0))"
+        ))
+        db._execute(SQL("CREATE INDEX subscriptions_seminar ON subscriptions (seminar_id, seminar_ctr)"))
+        # The table and its contents become visible to running processes at the same time
+        migrate_subscriptions()
+
+
+def migrate_subscriptions():
+    """
+    Copies the subscriptions stored in the users table into the subscriptions table.
+
+    Subscriptions already in the table are kept, so this can be rerun to pick up subscriptions
+    written to the users table by processes that hadn't yet noticed the table.
+    """
+    db._execute(SQL(
+        "INSERT INTO subscriptions (user_id, seminar_id, seminar_ctr) "
+        "SELECT id, unnest(seminar_subscriptions), NULL FROM users "
+        "UNION "
+        "SELECT users.id, series.key, ctr.value::text::integer FROM users, "
+        "jsonb_each(users.talk_subscriptions) AS series, jsonb_array_elements(series.value) AS ctr "
+        "ON CONFLICT DO NOTHING"
+    ))
+
+
+def users_subscriptions(uids):
+    """
+    The subscriptions of the given users, using one query.
+
+    INPUT:
+
+    - ``uids`` -- a list of user ids
+
+    OUTPUT:
+
+    A dictionary with keys the user ids and values pairs (seminar_subscriptions, talk_subscriptions),
+    in the same format as the legacy columns of the users table: a sorted list of series
+    and a dictionary from series to sorted lists of counters.
+    """
+    ans = {int(uid): ([], defaultdict(list)) for uid in uids}
+    cur = db._execute(
+        SQL(
+            "SELECT user_id, seminar_id, seminar_ctr FROM subscriptions "
+            "WHERE user_id = ANY(%s) ORDER BY seminar_id, seminar_ctr"
+        ),
+        [list(ans)],
+    )
+    for user_id, seminar_id, seminar_ctr in cur:
+        seminars, talks = ans[user_id]
+        if seminar_ctr is None:
+            seminars.append(seminar_id)
+        else:
+            talks[seminar_id].append(seminar_ctr)
+    return {uid: (seminars, dict(talks)) for (uid, (seminars, talks)) in ans.items()}
+
+
+def user_subscriptions(uid):
+    """
+    The pair (seminar_subscriptions, talk_subscriptions) for a single user; see users_subscriptions.
+    """
+    return users_subscriptions([uid])[int(uid)]
+
+
+def add_subscription(uid, seminar_id, seminar_ctr=None):
+    """
+    Subscribes a user to a series (if ``seminar_ctr`` is None) or a talk; does nothing if already subscribed.
+
+    Subscribing to a series replaces subscriptions to its individual talks.
+    """
+    with DelayCommit(db):
+        if seminar_ctr is None:
+            db._execute(
+                SQL("DELETE FROM subscriptions WHERE user_id = %s AND seminar_id = %s AND seminar_ctr IS NOT NULL"),
+                [int(uid), seminar_id],
+            )
+        db._execute(
+            SQL(
+                "INSERT INTO subscriptions (user_id, seminar_id, seminar_ctr) VALUES (%s, %s, %s) "
+                "ON CONFLICT DO NOTHING"
+            ),
+            [int(uid), seminar_id, seminar_ctr],
+        )
+
+
+def remove_subscriptions(uid, seminar_ids=[], talks=[]):
+    """
+    Removes subscriptions of a user to series and talks.
+
+    INPUT:
+
+    - ``uid`` -- a user id
+    - ``seminar_ids`` -- a list of series to unsubscribe from (subscriptions to their individual talks are kept)
+    - ``talks`` -- a list of pairs (seminar_id, seminar_ctr) to unsubscribe from
+    """
+    with DelayCommit(db):
+        if seminar_ids:
+            db._execute(
+                SQL("DELETE FROM subscriptions WHERE user_id = %s AND seminar_id = ANY(%s) AND seminar_ctr IS NULL"),
+                [int(uid), list(seminar_ids)],
+            )
+        for seminar_id, seminar_ctr in talks:
+            db._execute(
+                SQL("DELETE FROM subscriptions WHERE user_id = %s AND seminar_id = %s AND seminar_ctr = %s"),
+                [int(uid), seminar_id, seminar_ctr],
+            )
+
+
+def subscribers(seminar_id, seminar_ctr=None):
+    """
+    The ids of the users subscribed to a series (if ``seminar_ctr`` is None) or to a talk
+    (not including those subscribed to its whole series).
+    """
+    cur = db._execute(
+        SQL(
+            "SELECT user_id FROM subscriptions WHERE seminar_id = %s AND seminar_ctr IS NOT DISTINCT FROM %s ORDER BY user_id"
+        ),
+        [seminar_id, seminar_ctr],
+    )
+    return [rec[0] for rec in cur]
+
+
+def delete_subscriptions(user_id=None, seminar_id=None, seminar_ctr=None):
+    """
+    Deletes all subscriptions of a user, or to a series (including its talks) or talk,
+    for example when the user, series or talk is deleted.
+    """
+    conditions, values = [], []
+    for col, val in [("user_id", user_id), ("seminar_id", seminar_id), ("seminar_ctr", seminar_ctr)]:
+        if val is not None:
+            conditions.append(SQL("{0} = %s").format(IdentifierWrapper(col)))
+            values.append(val)
+    assert conditions
+    db._execute(SQL("DELETE FROM subscriptions WHERE {0}").format(SQL(" AND ").join(conditions)), values)
@@ -1,7 +1,7 @@
 import pytz
 import secrets
 from urllib.parse import urlencode, quote
-from flask import url_for, redirect, render_template
+from flask import url_for, redirect, render_template, request
 from flask_login import current_user
 from psycodict.utils import DelayCommit, IdentifierWrapper
 from seminars import db
@@ -10,11 +10,14 @@ from seminars.utils import (
     adapt_datetime,
     comma_list,
     count_distinct,
+    facet_counts_distinct,
     how_long,
     log_error,
+    last_edit_distinct,
     lucky_distinct,
     make_links,
     max_distinct,
+    refresh_current,
     sanitized_table,
     search_distinct,
 )
@@ -22,14 +25,22 @@ from seminars.language import languages
 from seminars.toggle import toggle
 from seminars.topic import topic_dag
 from seminars.seminar import WebSeminar, can_edit_seminar, audience_options
+from seminars.cache import bump_generation, LRUCache
+from seminars.subscriptions import subscriptions_table_exists, delete_subscriptions
 from .utils import flash_error
 from markupsafe import Markup
 from psycopg2.sql import SQL
 import urllib.parse
 from icalendar import Event
 from datetime import datetime, timedelta
+from collections import defaultdict
 import re
 
+# Rendered rows for the browse pages, keyed on the talk version and the viewer; see WebTalk.oneline
+oneline_cache = LRUCache(20000)
+# Serialized calendar events, keyed on the talk version and the viewer's access; see WebTalk.ics_event
+event_cache = LRUCache(20000)
+
 blackout_dates = [ # Use %Y-%m-%d format
     "2020-06-10",
 ]
@@ -214,14 +225,18 @@ class WebTalk(object):
             data["edited_by"] = -1
         data["edited_at"] = datetime.now(tz=pytz.UTC)
         self.validate()
-        db.talks.insert_many([data])
+        with DelayCommit(db):
+            db.talks.insert_many([data])
+            refresh_current(db.talks, {"seminar_id": self.seminar_id, "seminar_ctr": self.seminar_ctr})
 
     def save_admin(self):
         # Like save, but doesn't change edited_at
         data = {col: getattr(self, col, None) for col in db.talks.search_cols}
         assert data.get("seminar_id") and data.get("seminar_ctr")
         data["edited_by"] = 0
-        db.talks.insert_many([data])
+        with DelayCommit(db):
+            db.talks.insert_many([data])
+            refresh_current(db.talks, {"seminar_id": self.seminar_id, "seminar_ctr": self.seminar_ctr})
 
     def user_is_registered(self, user=None):
         if user is None: user = current_user
@@ -602,18 +617,21 @@ Thank you,
                 db.talks.delete({"seminar_id": self.seminar_id, "seminar_ctr": -self.seminar_ctr})
                 db.talks.update({"seminar_id": self.seminar_id, "seminar_ctr": self.seminar_ctr},
                                 {"deleted": True, "deleted_with_seminar": False})
-                for i, talk_sub in db._execute(
-                    SQL("SELECT {},{} FROM {} WHERE {} ? %s").format(
-                        *map(
-                            IdentifierWrapper,
-                            ["id", "talk_subscriptions", "users", "talk_subscriptions"],
-                        )
-                    ),
-                    [self.seminar.shortname],
-                ):
-                    if self.seminar_ctr in talk_sub[self.seminar.shortname]:
-                        talk_sub[self.seminar.shortname].remove(self.seminar_ctr)
-                        db.users.update({"id": i}, {"talk_subscriptions": talk_sub})
+                refresh_current(db.talks, {"seminar_id": self.seminar_id, "seminar_ctr": {"$in": [self.seminar_ctr, -self.seminar_ctr]}})
+                if subscriptions_table_exists():
+                    delete_subscriptions(seminar_id=self.seminar_id, seminar_ctr=self.seminar_ctr)
+                else:
+                    # Removes the counter from the list for this series, in one statement however many users are subscribed
+                    db._execute(
+                        SQL(
+                            "UPDATE {0} SET talk_subscriptions = jsonb_set(talk_subscriptions, ARRAY[%s], "
+                            "COALESCE((SELECT jsonb_agg(ctr) FROM jsonb_array_elements(talk_subscriptions -> %s) AS ctr "
+                            "WHERE ctr <> to_jsonb(%s::integer)), '[]'::jsonb)) "
+                            "WHERE talk_subscriptions -> %s @> jsonb_build_array(%s::integer)"
+                        ).format(IdentifierWrapper("users")),
+                        [self.seminar_id, self.seminar_id, self.seminar_ctr, self.seminar_id, self.seminar_ctr],
+                    )
+                    bump_generation("users")
             self.deleted = True
             return True
         else:
@@ -639,6 +657,31 @@ Thank you,
         return self.seminar_ctr < 0
 
     def oneline(self, include_seminar=True, include_content=False, include_subscribe=True, tz=None, _external=False):
+        # Rescheduled and deleted talks depend on other talks and on the viewer, so we only cache the usual case
+        edited_at = getattr(self, "edited_at", None)
+        if self.rescheduled() or self.deleted or _external or edited_at is None:
+            return self._oneline(include_seminar, include_content, include_subscribe, tz, _external)
+        now = datetime.now(pytz.UTC)
+        key = (
+            self.seminar_id,
+            self.seminar_ctr,
+            edited_at,
+            getattr(self.seminar, "edited_at", None),
+            str(tz if tz is not None else current_user.tz),
+            None if current_user.is_anonymous else self.is_subscribed(),
+            self.start_time < now < self.end_time,
+            now.year,
+            include_seminar,
+            include_content,
+            include_subscribe,
+        )
+        ans = oneline_cache.get(key)
+        if ans is None:
+            ans = self._oneline(include_seminar, include_content, include_subscribe, tz, _external)
+            oneline_cache.set(key, ans)
+        return ans
+
+    def _oneline(self, include_seminar=True, include_content=False, include_subscribe=True, tz=None, _external=False):
         rescheduled = self.rescheduled()
         t, now, e = adapt_datetime(self.start_time, newtz=tz), adapt_datetime(datetime.now(), newtz=tz), adapt_datetime(self.end_time, newtz=tz)
         if rescheduled:
@@ -705,6 +748,45 @@ Email link to speaker
         )
 
 
+    def _event_access_key(self, user):
+        # The parts of the viewer (and of the current time) that affect the links included by event()
+        if not self.online or self.is_past():
+            return None
+        if self.access_control == 1:
+            now = datetime.now(pytz.utc)
+            return self.start_time - timedelta(minutes=self.access_time) <= now
+        if self.access_control == 5:
+            if user.is_anonymous:
+                return False
+            registered = bool(db.seminar_registrations.lucky({'seminar_id': self.seminar_id, 'email': user.email}))
+            return (registered, user.email_confirmed)
+        return None
+
+    def ics_event(self, user):
+        """
+        The serialized calendar event for this talk, as seen by ``user``.
+
+        The result is cached across requests, keyed on the version of the talk and its seminar
+        and on the parts of ``user`` that determine which links are included.
+        """
+        edited_at = getattr(self, "edited_at", None)
+        if edited_at is None:
+            return self.event(user=user).to_ical()
+        key = (
+            self.seminar_id,
+            self.seminar_ctr,
+            edited_at,
+            self.deleted,
+            getattr(self.seminar, "edited_at", None),
+            request.host_url,
+            self._event_access_key(user),
+        )
+        ans = event_cache.get(key)
+        if ans is None:
+            ans = self.event(user=user).to_ical()
+            event_cache.set(key, ans)
+        return ans
+
     def event(self, user):
         link = url_for("show_talk", seminar_id=self.seminar_id, talkid=self.seminar_ctr,
                        _external=True, _scheme='https')
@@ -753,10 +835,44 @@ Email link to speaker
 
         event.add("description", desc)
         event.add("location", link)
-        event.add("DTSTAMP", datetime.now(tz=pytz.UTC))
+        # Use the time of the last edit rather than the current time, so that the output only changes with the talk
+        edited_at = getattr(self, "edited_at", None)
+        event.add("DTSTAMP", datetime.now(tz=pytz.UTC) if edited_at is None else adapt_datetime(edited_at, pytz.UTC))
         event.add("UID", "%s/%s" % (self.seminar_id, self.seminar_ctr))
         return event
 
+def save_talks(talks, user=None):
+    """
+    Saves new versions of several talks using a single insert, so that either all or none are saved.
+
+    INPUT:
+
+    - ``talks`` -- a list of WebTalk objects, with ``seminar_ctr`` already set
+    - ``user`` -- the user making the changes (defaults to the current user)
+    """
+    if not talks:
+        return
+    if user is None: user = current_user
+    try:
+        edited_by = int(user.id)
+    except (ValueError, AttributeError, TypeError):
+        # Talks can be edited by anonymous users with a token, with no id
+        edited_by = -1
+    edited_at = datetime.now(tz=pytz.UTC)
+    rows = []
+    ctrs = defaultdict(list)
+    for talk in talks:
+        data = {col: getattr(talk, col, None) for col in db.talks.search_cols}
+        assert data.get("seminar_id") and data.get("seminar_ctr")
+        data["edited_by"] = edited_by
+        data["edited_at"] = edited_at
+        talk.validate()
+        rows.append(data)
+        ctrs[talk.seminar_id].append(talk.seminar_ctr)
+    with DelayCommit(db):
+        db.talks.insert_many(rows)
+        refresh_current(db.talks, {"$or": [{"seminar_id": seminar_id, "seminar_ctr": {"$in": L}} for (seminar_id, L) in ctrs.items()]})
+
 def talks_header(include_seminar=True, include_content=False, include_subscribe=True, datetime_header="Your time"):
     cols = []
     cols.append((' colspan="3" class="yourtime"', datetime_header))
@@ -872,11 +988,13 @@ def _iterator(seminar_dict, objects=True, more=False):
     return object_iterator if objects else db.talks._search_iterator
 
 
-def talks_count(query={}, include_deleted=False):
+def talks_count(query={}, include_deleted=False, include_pending=False):
     """
     Replacement for db.talks.count to account for versioning and so that we don't cache results.
+
+    Versions awaiting approval are only counted if ``include_pending`` is set, which scans the version history.
     """
-    return count_distinct(db.talks, _counter, query, include_deleted)
+    return count_distinct(db.talks, _counter, query, include_deleted, include_pending)
 
 
 def talks_max(col, constraint={}, include_deleted=False):
@@ -886,11 +1004,51 @@ def talks_max(col, constraint={}, include_deleted=False):
     return max_distinct(db.talks, _maxer, col, constraint, include_deleted)
 
 
+def talks_facets(col, query={}, array=False, include_deleted=False):
+    """
+    A Counter giving the number of talks matching ``query`` with each value of ``col`` (each entry of ``col`` if ``array``).
+    """
+    return facet_counts_distinct(db.talks, _selecter, col, query, array=array, include_deleted=include_deleted)
+
+
+# The most recent time at which a talk's links changed without the talk being edited: for online talks,
+# links are revealed access_time minutes before the start if access_control is 1, and removed once the talk
+# is past (see _event_access_key).  Both placeholders are the current time.
+_access_changed = SQL(
+    "MAX(GREATEST("
+    "CASE WHEN end_time + interval '60 minutes' < %s THEN end_time + interval '60 minutes' END, "
+    "CASE WHEN access_control = 1 AND start_time - access_time * interval '1 minute' <= %s "
+    "THEN start_time - access_time * interval '1 minute' END"
+    ")) FILTER (WHERE online)"
+)
+
+
+def talks_last_edit(query={}, include_deleted=False):
+    """
+    The most recent edit time among talks matching ``query``, their number, and the most recent time
+    at which the links shown in their calendar events changed on their own; see ``feed_validators``.
+    """
+    now = datetime.now(pytz.UTC)
+    return last_edit_distinct(db.talks, _selecter, query, include_deleted, extra=(_access_changed, [now, now]))
+
+
+def viewer_access_state(user, seminar_ids):
+    """
+    The parts of ``user`` that determine which links are shown in the calendar events of talks
+    in the given series (see _event_access_key), for inclusion in ``feed_validators``.
+    """
+    if user.is_anonymous:
+        return None
+    registered = sorted(set(db.seminar_registrations.search(
+        {"seminar_id": {"$in": sorted(seminar_ids)}, "email": user.email}, "seminar_id")))
+    return (user.id, user.email, user.email_confirmed, registered)
+
+
 def talks_search(*args, **kwds):
     """
     Replacement for db.talks.search to account for versioning, return WebTalk objects.
 
-    Doesn't support split_ors or raw.  Always computes count.
+    Doesn't support split_ors or raw.  Computes a count only when info is provided.
     """
     seminar_dict = kwds.pop("seminar_dict", {})
     objects = kwds.pop("objects", True)
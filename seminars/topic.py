@@ -4,6 +4,7 @@ from .utils import num_columns
 from flask import request
 from collections import defaultdict, Counter
 from psycodict.utils import DelayCommit
+from .cache import bump_generation
 import re
 
 
@@ -15,13 +16,16 @@ class WebTopic(object):
         # the following are filled in by TopicDAG __init__
         self.children = []
         self.parents = []
+        # ids of the topics above and below this one, not including itself
+        self.ancestor_ids = frozenset()
+        self.descendant_ids = frozenset()
+        self.child_ids = frozenset()
+        self._ancestors = []
 
     @property
     def ancestors(self):
-        if not self.parents:
-            return []
-        else:
-            return sorted(set([elt.id for elt in self.parents] + sum([elt.ancestors for elt in self.parents], [])))
+        # A sorted list of the ids in ancestor_ids; it is shared, so don't modify it
+        return self._ancestors
 
     def json(self, selected=[]):
         return {
@@ -56,6 +60,23 @@ class TopicDAG(object):
             (topic for topic in self.by_id.values() if not topic.parents), key=sort_key
         )
 
+        # Precompute the transitive closures, so that ancestors and descendants are lookups
+        def closure(topic, attr, memo):
+            if topic.id not in memo:
+                res = set()
+                for elt in getattr(topic, attr):
+                    res.add(elt.id)
+                    res.update(closure(elt, attr, memo))
+                memo[topic.id] = frozenset(res)
+            return memo[topic.id]
+
+        ancestors, descendants = {}, {}
+        for topic in self.by_id.values():
+            topic.ancestor_ids = closure(topic, "parents", ancestors)
+            topic.descendant_ids = closure(topic, "children", descendants)
+            topic.child_ids = frozenset(elt.id for elt in topic.children)
+            topic._ancestors = sorted(topic.ancestor_ids)
+
     def add_topics(self, filename, dryrun=False):
         """
         File format: one line for each topic, asterisks to indicate children, tilde for dividing topic id from topic name.
@@ -118,6 +139,7 @@ class TopicDAG(object):
                 db.new_topics.insert_many(topic_list)
                 for tid, children in updates.items():
                     db.new_topics.update({"topic_id": tid}, {"children": children})
+                bump_generation("new_topics")
 
     def filtered_topics(self, topic=None):
         cookie = self.read_cookie()
@@ -129,6 +151,21 @@ class TopicDAG(object):
                 res.extend(self.filtered_topics(elt))
         return res
 
+    def descendants(self, topic_id):
+        """
+        The set of ids of topics below the given topic (not including the topic itself)
+        """
+        return self.by_id[topic_id].descendant_ids
+
+    def expand(self, topic_list):
+        """
+        The set of ids of the given topics together with all topics below them
+        """
+        res = set(topic_list)
+        for topic in topic_list:
+            res.update(self.by_id[topic].descendant_ids)
+        return res
+
     def leaves(self, topic_list):
         """
         Returns the elements in the topic list that don't have children in the topic list
@@ -141,10 +178,11 @@ class TopicDAG(object):
 
         The names of topics with no children also in the list
         """
+        topic_set = set(topic_list)
         leaves = []
         for topic in topic_list:
             topic = self.by_id[topic]
-            if all(child.id not in topic_list for child in topic.children):
+            if topic.child_ids.isdisjoint(topic_set):
                 leaves.append(topic.name)
         return leaves
 
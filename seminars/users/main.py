@@ -27,7 +27,9 @@ from markupsafe import Markup
 from seminars import db
 
 from seminars.utils import (
+    feed_validators,
     ics_file,
+    not_modified,
     process_user_input,
     format_errmsg,
     format_input_errmsg,
@@ -39,6 +41,8 @@ from seminars.utils import (
 )
 
 from seminars.tokens import generate_timed_token, read_timed_token, read_token
+from seminars.talk import talks_last_edit, viewer_access_state
+from seminars.seminar import seminars_last_edit
 from datetime import datetime
 
 def user_options():
@@ -56,7 +60,7 @@ from .pwdmanager import userdb, SeminarsUser, SeminarsAnonymousUser
 
 @login_manager.user_loader
 def load_user(uid):
-    return SeminarsUser(uid)
+    return SeminarsUser.load(uid)
 
 
 login_manager.login_view = "user.info"
@@ -628,10 +632,25 @@ def user_ics_file(token):
             return flask.abort(404, "The email address has not yet been confirmed!")
     except Exception:
         return flask.abort(404, "Invalid link")
+    # The feed depends on the user's subscriptions, and on the date if it is limited to nearby talks
+    series = sorted(set(user.seminar_subscriptions).union(user.talk_subscriptions))
+    window = datetime.utcnow().date() if (user.ics_limit_past or user.ics_limit_future) else None
+    etag, last_modified = feed_validators(
+        [talks_last_edit(user.ics_query), seminars_last_edit({"shortname": {"$in": series}})],
+        viewer_access_state(user, series),
+        user.seminar_subscriptions,
+        sorted(user.talk_subscriptions.items()),
+        window,
+    )
+    response = not_modified(etag, last_modified)
+    if response is not None:
+        return response
     return ics_file(
         talks=user.ics_talks,
         filename="seminars.ics",
-        user=user)
+        user=user,
+        etag=etag,
+        last_modified=last_modified)
 
 
 
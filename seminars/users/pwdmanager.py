@@ -8,8 +8,17 @@ from seminars import db
 from seminars.tokens import generate_token
 from seminars.seminar import seminars_search, seminars_lucky, next_talk_sorted, all_seminars
 from seminars.talk import talks_search
-from seminars.utils import pretty_timezone, log_error
+from seminars.utils import pretty_timezone, log_error, refresh_current
+from seminars.cache import bump_generation, table_generations, LRUCache
 from seminars.toggle import toggle
+from seminars.subscriptions import (
+    subscriptions_table_exists,
+    users_subscriptions,
+    user_subscriptions,
+    add_subscription,
+    remove_subscriptions,
+    delete_subscriptions,
+)
 from psycodict.searchtable import PostgresSearchTable
 from seminars.utils import flash_error
 from flask import flash
@@ -18,6 +27,8 @@ from datetime import datetime, timedelta
 from pytz import UTC, all_timezones, timezone, UnknownTimeZoneError
 import bisect
 import secrets
+from copy import deepcopy
+from time import monotonic
 from .main import logger
 from collections import defaultdict
 
@@ -105,12 +116,14 @@ class PostgresUserTable(PostgresSearchTable):
         return newuser
 
     def change_password(self, email, newpwd):
-        self.update(
-            query={"email": ilike_query(email)},
-            changes={"password": self.bchash(newpwd)},
-            resort=False,
-            restat=False,
-        )
+        with DelayCommit(db):
+            self.update(
+                query={"email": ilike_query(email)},
+                changes={"password": self.bchash(newpwd)},
+                resort=False,
+                restat=False,
+            )
+            bump_generation("users")
         logger.info("password for %s changed!" % email)
 
     def lookup(self, email, projection=2):
@@ -132,11 +145,14 @@ class PostgresUserTable(PostgresSearchTable):
     def make_creator(self, email, endorser):
         with DelayCommit(self):
             db.users.update({"email": ilike_query(email)}, {"creator": True, "endorser": endorser}, restat=False)
+            bump_generation("users")
             # Update all of this user's created seminars and talks
             db.seminars.update({"owner": ilike_query(email)}, {"display": True})
+            refresh_current(db.seminars, {"owner": ilike_query(email)})
             # Could do this with a join...
             for sem in seminars_search({"owner": ilike_query(email)}, "shortname"):
                 db.talks.update({"seminar_id": sem}, {"display": True}, restat=False)
+                refresh_current(db.talks, {"seminar_id": sem})
 
     def save(self, data):
         data = dict(data)  # copy
@@ -171,8 +187,12 @@ class PostgresUserTable(PostgresSearchTable):
                 db.institutions.update({"admin": ilike_query(email)}, {"admin": newemail})
                 db.seminars.update({"owner": ilike_query(email)}, {"owner": newemail})
                 db.seminar_organizers.update({"email": ilike_query(email)}, {"email": newemail})
+                bump_generation("seminar_organizers")
                 db.talks.update({"speaker_email": ilike_query(email)}, {"speaker_email": newemail})
+                refresh_current(db.seminars, {"owner": newemail})
+                refresh_current(db.talks, {"speaker_email": newemail})
             self.update({"email": ilike_query(email)}, data, restat=False)
+            bump_generation("users")
         return True
 
     def delete(self, data):
@@ -180,20 +200,36 @@ class PostgresUserTable(PostgresSearchTable):
         uid = data["id"]
         email = data["email"]
         with DelayCommit(db):
+            owned = list(db.seminars.search({"owner": ilike_query(email)}, "shortname"))
+            spoken = list(db.talks.search({"speaker_email": ilike_query(email)}, "seminar_id"))
             # We probably have code that assumes that admin/owner isn't None....
             db.institutions.update({"admin": ilike_query(email)}, {"admin": "researchseminars@mit.edu"})
             db.seminars.update({"owner": ilike_query(email)}, {"owner": "researchseminars@mit.edu"})
             db.seminar_organizers.delete({"email": ilike_query(email)})
+            bump_generation("seminar_organizers")
             db.talks.update({"speaker_email": ilike_query(email)}, {"speaker_email": ""})
+            refresh_current(db.seminars, {"shortname": {"$in": owned}})
+            refresh_current(db.talks, {"seminar_id": {"$in": spoken}})
             self.update({"id": uid}, {key: None for key in self.search_cols}, restat=False)
+            if subscriptions_table_exists():
+                delete_subscriptions(user_id=int(uid))
+            bump_generation("users")
 
     def reset_api_token(self, uid):
         new_token = secrets.token_urlsafe(32)
-        self.update({"id": int(uid)}, {"api_token": new_token}, restat=False)
+        with DelayCommit(db):
+            self.update({"id": int(uid)}, {"api_token": new_token}, restat=False)
+            # invalidates users cached by the API
+            bump_generation("users")
         return new_token
 
 userdb = PostgresUserTable()
 
+# Database rows of users loaded by SeminarsUser.load, keyed on uid
+user_cache = LRUCache(10000)
+# Number of seconds for which a cached row is reused (changes to the users table invalidate it sooner)
+USER_TTL = 60
+
 
 class SeminarsUser(UserMixin):
     """
@@ -202,8 +238,11 @@ class SeminarsUser(UserMixin):
 
     properties = sorted(userdb.col_type) + ["id"]
 
-    def __init__(self, uid=None, email=None):
-        if email:
+    def __init__(self, uid=None, email=None, row=None):
+        # row is a cached database row for this user (see load), in which case no queries are made
+        if row is not None:
+            query = None
+        elif email:
             if not isinstance(email, str):
                 raise Exception("Email is not a string, %s" % email)
             query = {"email": ilike_query(email)}
@@ -217,18 +256,72 @@ class SeminarsUser(UserMixin):
         self._uid = None
         self._dirty = False  # flag if we have to save
         self._data = dict() # dict([(_, None) for _ in SeminarsUser.properties])
+        self._is_organizer = None  # computed when needed; see _organizer
+        self._subscriptions = None  # loaded when needed; see _load_subscriptions
+        self._cache_entry = None  # set by load
 
-        if not db._read_only: # this if prevents logging in when the database is in read-only mode
+        if row is not None:
+            self._set_row(row)
+        elif not db._read_only: # this if prevents logging in when the database is in read-only mode
             user_row = userdb.lucky(query, projection=SeminarsUser.properties)
             if user_row:
-                self._authenticated = True
-                self._data.update(user_row)
-                self._uid = str(self._data["id"])
-                self._organizer = (
-                    db.seminar_organizers.count({"email": ilike_query(self.email)}, record=False) > 0
-                )
+                self._set_row(user_row)
                 self.try_to_endorse()
 
+    def _set_row(self, user_row):
+        self._authenticated = True
+        self._data.update(user_row)
+        self._uid = str(self._data["id"])
+
+    @classmethod
+    def load(cls, uid):
+        """
+        Returns ``SeminarsUser(uid)``, reusing the row loaded by an earlier call
+        if it is less than USER_TTL seconds old and neither the users nor the seminar_organizers table has changed since.
+
+        This is used to load the logged in user on each request, so that most page views make no queries for the user.
+        """
+        generations = table_generations()
+        try:
+            uid = int(uid)
+        except (TypeError, ValueError):
+            generations = None
+        # Without generations we can't notice changes made by other processes, so nothing is cached
+        if generations is None or db._read_only:
+            return cls(uid)
+        stamp = (generations.get("users", 0), generations.get("seminar_organizers", 0))
+        hit = user_cache.get(uid)
+        if hit is not None and hit[0] == stamp and monotonic() < hit[1]:
+            # Endorsement was already attempted when the row was cached, and any change since would have
+            # changed the stamp, so we don't call try_to_endorse
+            user = cls(row=deepcopy(hit[2]))
+            user._is_organizer = hit[3]
+        else:
+            user = cls(uid)
+            if user.id is None:
+                return user
+            # try_to_endorse may have modified the user, so we store the row as saved
+            hit = (stamp, monotonic() + USER_TTL, deepcopy(user._data), user._is_organizer)
+            user_cache.set(uid, hit)
+        user._cache_entry = hit
+        return user
+
+    @property
+    def _organizer(self):
+        """
+        Whether this user is an organizer of some series.  This requires a query, so is only computed when needed.
+        """
+        if self._is_organizer is None:
+            self._is_organizer = (
+                db.seminar_organizers.count({"email": ilike_query(self.email)}, record=False) > 0
+            )
+            # Record the result for later requests
+            entry = self._cache_entry
+            if entry is not None and user_cache.get(int(self._uid)) is entry:
+                self._cache_entry = entry[:3] + (self._is_organizer,)
+                user_cache.set(int(self._uid), self._cache_entry)
+        return self._is_organizer
+
     def try_to_endorse(self):
         if self.email_confirmed and not self.is_creator:
             preendorsed = db.preendorsed_users.lucky({"email": ilike_query(self.email)})
@@ -389,8 +482,21 @@ class SeminarsUser(UserMixin):
     def ics_webcal_link(self):
         return url_for(".user_ics_file", token=self.ics, _external=True, _scheme="webcal")
 
+    def _load_subscriptions(self):
+        """
+        Whether subscriptions are stored in the subscriptions table rather than the users table,
+        loading this user's subscriptions from it the first time.
+        """
+        if self._uid is None or not subscriptions_table_exists():
+            return False
+        if self._subscriptions is None:
+            self._subscriptions = user_subscriptions(self._uid)
+        return True
+
     @property
     def seminar_subscriptions(self):
+        if self._load_subscriptions():
+            return self._subscriptions[0]
         return self._data.get("seminar_subscriptions", [])
 
     @property
@@ -398,38 +504,41 @@ class SeminarsUser(UserMixin):
         seminars = all_seminars()
         ans = []
         for elt in self.seminar_subscriptions:
-            try:
-                sem = seminars[elt]
-                if sem.visibility != 0 or sem.user_can_edit():
-                    ans.append(sem)
-            except (KeyError, ValueError):
-                self._data["seminar_subscriptions"].remove(elt)
-                self._dirty = True
-        ans = next_talk_sorted(ans)
-        if self._dirty:
-            self.save()
-        return ans
+            sem = seminars.get(elt)
+            if sem is None:
+                # Deleted series are removed from the subscriptions later; see prune_all_subscriptions
+                continue
+            if sem.visibility != 0 or sem.user_can_edit():
+                ans.append(sem)
+        return next_talk_sorted(ans)
 
     def seminar_subscriptions_add(self, shortname):
-        if shortname not in self._data["seminar_subscriptions"]:
-            bisect.insort(self._data["seminar_subscriptions"], shortname)
-            if shortname in self.talk_subscriptions:
-                self._data["talk_subscriptions"].pop(shortname)
-            self._dirty = True
+        if shortname not in self.seminar_subscriptions:
+            bisect.insort(self.seminar_subscriptions, shortname)
+            self.talk_subscriptions.pop(shortname, None)
+            if self._load_subscriptions():
+                add_subscription(self._uid, shortname)
+            else:
+                self._dirty = True
             return 200, "Added to favorites"
         else:
             return 200, "Already added to favorites"
 
     def seminar_subscriptions_remove(self, shortname):
-        if shortname in self._data["seminar_subscriptions"]:
-            self._data["seminar_subscriptions"].remove(shortname)
-            self._dirty = True
+        if shortname in self.seminar_subscriptions:
+            self.seminar_subscriptions.remove(shortname)
+            if self._load_subscriptions():
+                remove_subscriptions(self._uid, seminar_ids=[shortname])
+            else:
+                self._dirty = True
             return 200, "Removed from favorites"
         else:
             return 200, "Already removed from favorites"
 
     @property
     def talk_subscriptions(self):
+        if self._load_subscriptions():
+            return self._subscriptions[1]
         return self._data.get("talk_subscriptions", {})
 
     @property
@@ -445,23 +554,22 @@ class SeminarsUser(UserMixin):
     @property
     def talks(self):
         query = {'$or': self.talks_query, 'hidden': {"$or": [False, {"$exists": False}]}}
-        res = [t for t in talks_search(query,
-                                       sort=["start_time"],
-                                       seminar_dict=all_seminars())
-               if t.searchable() or t.user_can_edit(user=self)]
-        talk_subscriptions = defaultdict(list)
-
-        for t in res:
-            bisect.insort(talk_subscriptions[t.seminar_id], t.seminar_ctr)
-
-        if talk_subscriptions != self.talk_subscriptions:
-            self._data["talk_subscriptions"] = talk_subscriptions
-            self.save()
-
-        return res
+        # Subscribed talks that are gone are removed from the subscriptions later; see prune_all_subscriptions
+        return [t for t in talks_search(query,
+                                        sort=["start_time"],
+                                        seminar_dict=all_seminars())
+                if t.searchable() or t.user_can_edit(user=self)]
 
     @property
     def ics_talks(self):
+        """
+        A generator over the talks in this user's calendar feed, read lazily from the database.
+        """
+        return (t for t in talks_search(self.ics_query, seminar_dict=all_seminars(), lazy=True)
+                if t.searchable() or t.user_can_edit(user=self))
+
+    @property
+    def ics_query(self):
         query = self.talks_query[:]
         for shortname in self.seminar_subscriptions:
             query.append({'seminar_id': shortname})
@@ -474,33 +582,34 @@ class SeminarsUser(UserMixin):
             query_st['$lte'] = now + timedelta(days=31)
         if query_st:
             query['start_time'] = query_st
-        res = [t for t in talks_search(query,
-                                       seminar_dict=all_seminars())
-               if t.searchable() or t.user_can_edit(user=self)]
-        res.sort(key=lambda elt:
-                 now - elt.start_time if now > elt.start_time else elt.start_time - now)
-        return res
+        return query
 
 
     def talk_subscriptions_add(self, shortname, ctr):
-        if shortname in self._data["seminar_subscriptions"]:
+        if shortname in self.seminar_subscriptions:
             return 200, "Talk is in saved seminar"
-        elif ctr in self._data["talk_subscriptions"].get(shortname, []):
+        elif ctr in self.talk_subscriptions.get(shortname, []):
             return 200, "Already added to favorites"
         else:
-            if shortname in self._data["talk_subscriptions"]:
-                bisect.insort(self._data["talk_subscriptions"][shortname], ctr)
+            if shortname in self.talk_subscriptions:
+                bisect.insort(self.talk_subscriptions[shortname], ctr)
             else:
-                self._data["talk_subscriptions"][shortname] = [ctr]
-            self._dirty = True
+                self.talk_subscriptions[shortname] = [ctr]
+            if self._load_subscriptions():
+                add_subscription(self._uid, shortname, ctr)
+            else:
+                self._dirty = True
             return 200, "Added to favorites"
 
     def talk_subscriptions_remove(self, shortname, ctr):
-        if shortname in self._data["seminar_subscriptions"]:
+        if shortname in self.seminar_subscriptions:
             return 400, "Talk is part of favorited seminar"
-        if ctr in self._data["talk_subscriptions"].get(shortname, []):
-            self._data["talk_subscriptions"][shortname].remove(ctr)
-            self._dirty = True
+        if ctr in self.talk_subscriptions.get(shortname, []):
+            self.talk_subscriptions[shortname].remove(ctr)
+            if self._load_subscriptions():
+                remove_subscriptions(self._uid, talks=[(shortname, ctr)])
+            else:
+                self._dirty = True
             return 200, "Removed from favorites"
         else:
             return 200, "Already removed from favorites"
@@ -635,6 +744,75 @@ class SeminarsUser(UserMixin):
         self._dirty = True
         return 200, "Change recorded"
 
+def prune_subscriptions(uids):
+    """
+    Removes deleted series, and talks that are deleted or no longer visible to the user,
+    from the subscriptions of the given users.
+
+    This used to happen when a user's favorites were displayed; it is now done in batches by prune_all_subscriptions
+    so that reading subscriptions never writes to the database.
+
+    INPUT:
+
+    - ``uids`` -- a list of user ids
+    """
+    if not uids:
+        return
+    users = [SeminarsUser(row=row) for row in userdb.search({"id": {"$in": uids}}, SeminarsUser.properties)]
+    use_table = subscriptions_table_exists()
+    if use_table:
+        subscriptions = users_subscriptions([user.id for user in users])
+        for user in users:
+            user._subscriptions = subscriptions[int(user.id)]
+    seminars = all_seminars()
+    talks_query = [{"seminar_id": shortname, "seminar_ctr": {"$in": ctrs}}
+                   for user in users
+                   for (shortname, ctrs) in user.talk_subscriptions.items() if ctrs]
+    found = defaultdict(list)
+    if talks_query:
+        query = {"$or": talks_query, "hidden": {"$or": [False, {"$exists": False}]}}
+        for t in talks_search(query, seminar_dict=seminars):
+            found[t.seminar_id, t.seminar_ctr].append(t)
+    with DelayCommit(db):
+        changed = False
+        for user in users:
+            removed_seminars = [elt for elt in user.seminar_subscriptions if elt not in seminars]
+            removed_talks = [(shortname, ctr)
+                             for (shortname, ctrs) in user.talk_subscriptions.items() for ctr in ctrs
+                             if not any(t.searchable() or t.user_can_edit(user=user) for t in found[shortname, ctr])]
+            if use_table:
+                remove_subscriptions(user.id, removed_seminars, removed_talks)
+                continue
+            changes = {}
+            if removed_seminars:
+                changes["seminar_subscriptions"] = [elt for elt in user.seminar_subscriptions if elt in seminars]
+            talk_subscriptions = defaultdict(list)
+            for shortname, ctrs in user.talk_subscriptions.items():
+                for ctr in ctrs:
+                    if (shortname, ctr) not in removed_talks:
+                        bisect.insort(talk_subscriptions[shortname], ctr)
+            if talk_subscriptions != user.talk_subscriptions:
+                changes["talk_subscriptions"] = talk_subscriptions
+            if changes:
+                userdb.update({"id": int(user.id)}, changes, restat=False)
+                changed = True
+        if changed:
+            bump_generation("users")
+
+# Number of users handled by each call to prune_subscriptions in prune_all_subscriptions
+PRUNE_BATCH = 500
+
+def prune_all_subscriptions():
+    """
+    Calls prune_subscriptions on all users, in batches.
+
+    This is run periodically in its own process (see prune-subscriptions.py), so that it
+    has its own database connection rather than sharing the one used to serve requests.
+    """
+    uids = sorted(int(uid) for uid in userdb.search({}, "id"))
+    for i in range(0, len(uids), PRUNE_BATCH):
+        prune_subscriptions(uids[i:i + PRUNE_BATCH])
+
 class SeminarsAnonymousUser(AnonymousUserMixin):
     """
     The sole purpose of this Anonymous User is the 'is_admin' method
@@ -1,14 +1,14 @@
+from collections import Counter
 from collections.abc import Iterable
 from datetime import datetime, timedelta
 from datetime import time as maketime
 from dateutil.parser import parse as parse_time
 from email_validator import validate_email
-from flask import url_for, flash, render_template, request, send_file
+from flask import url_for, flash, render_template, request, Response, stream_with_context
 from flask_login import current_user
 from functools import lru_cache
 from icalendar import Calendar
-from io import BytesIO
-from psycodict.utils import IdentifierWrapper
+from psycodict.utils import IdentifierWrapper, DelayCommit
 from seminars.search_boxes import SearchBox
 from markupsafe import Markup, escape
 from psycopg2.sql import SQL
@@ -16,10 +16,13 @@ from seminars import db
 from six import string_types
 from urllib.parse import urlparse, urlencode
 from psycopg2.sql import Placeholder
+import hashlib
+import itertools
 import pytz
 import re
 from psycodict.searchtable import PostgresSearchTable
 from .toggle import toggle
+from .cache import bump_generation
 
 
 weekdays = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
@@ -337,28 +340,363 @@ def clean_topics(inp):
             inp = [inp]
     if isinstance(inp, Iterable):
         filled = set(elt for elt in inp if elt in topic_dag.by_id)
-        size = 0
-        while len(filled) != size:
-            size = len(filled)
-            for elt in set(filled):
-                for supertopic in topic_dag.by_id[elt].parents:
-                    filled.add(supertopic.id)
+        for elt in list(filled):
+            filled.update(topic_dag.by_id[elt].ancestor_ids)
         return sorted(filled)
     return []
 
 
-def count_distinct(table, counter, query={}, include_deleted=False):
+# Versions created through the API are hidden until approved
+_prequery = {'$or': [{'display': True}, {'by_api': False}]}
+
+# The seminars and talks tables store every version of each row.  We also maintain
+# tables seminars_current and talks_current with the same columns, holding only the
+# most recent non-pending version for each key (including deleted rows), so that
+# searches don't need to sort the whole history with DISTINCT ON.
+current_keys = {"seminars": ["shortname"], "talks": ["seminar_id", "seminar_ctr"]}
+current_indexes = {"seminars": [], "talks": [["start_time", "seminar_id", "seminar_ctr"], ["end_time"]]}
+# Set to False to always scan the version history
+use_current_tables = True
+# Rows of the current tables, and tombstones, are only reported by changed_since once they are this old,
+# so that transactions that drew earlier values of the change counter have committed (see changes_until)
+CHANGES_LAG = timedelta(seconds=60)
+
+# Whether a current row is public, in which case the changes API endpoint returns it as visible.
+# Rows, and their tombstones, remember in the column published whether they have ever been public,
+# so that the endpoint only reports the removal of rows that callers may have seen.
+_series_public = SQL("display IS TRUE AND deleted IS NOT TRUE AND (visibility IS NULL OR visibility > 1)")
+_public_condition = {
+    "seminars": _series_public,
+    "talks": SQL(
+        "display IS TRUE AND deleted IS NOT TRUE AND hidden IS NOT TRUE "
+        "AND seminar_id IN (SELECT shortname FROM seminars_current WHERE {0})"
+    ).format(_series_public),
+}
+
+_current_selecter = SQL("SELECT {0} FROM (SELECT {1} FROM {2}) tmp{3}")
+_current_counter = SQL("SELECT COUNT(*) FROM (SELECT {0} FROM {1}) tmp{2}")
+
+
+# Tables found by _current_table_exists
+_current_tables_found = set()
+
+
+def _current_table_exists(name):
+    # Once the table exists it stays, so only a negative answer needs to be checked again;
+    # processes started before build_current_tables switch to the table as soon as it is created
+    if name not in _current_tables_found:
+        cur = db._execute(SQL("SELECT to_regclass(%s)"), [name + "_current"])
+        if cur.fetchone()[0] is not None:
+            _current_tables_found.add(name)
+    return name in _current_tables_found
+
+
+def current_table(table, include_pending=False, versioned=False):
+    """
+    The name of the table holding the current versions of the rows in ``table``,
+    or None if the version history should be scanned instead.
+    """
+    name = table.search_table
+    if versioned or include_pending or not use_current_tables or name not in current_keys:
+        return None
+    if _current_table_exists(name):
+        return name + "_current"
+
+
+def refresh_current(table, query={}):
+    """
+    Recomputes the current version of every row in ``table`` with a version matching ``query``.
+
+    This should be called after any insert, update or delete on db.seminars or db.talks,
+    with ``query`` describing the affected rows after the change.  It also bumps the table's
+    generation (even if the current tables haven't been built), invalidating caches built from it.
+
+    INPUT:
+
+    - ``table`` -- db.seminars or db.talks
+    - ``query`` -- a dictionary, as for search; the empty query refreshes everything
+    """
+    name = table.search_table
+    if not _current_table_exists(name):
+        # Caches built from the table still need to notice the change
+        bump_generation(name)
+        return
+    keys = SQL(", ").join(map(IdentifierWrapper, current_keys[name]))
+    cols = SQL(", ").join(map(IdentifierWrapper, ["id"] + table.search_cols))
+    tbl = IdentifierWrapper(name)
+    curtbl = IdentifierWrapper(name + "_current")
+    tombs = IdentifierWrapper(name + "_tombstones")
+    qstr, values = table._parse_dict(query)
+    if qstr is None:
+        qstr, values = SQL("TRUE"), []
+    pqstr, pqvalues = table._parse_dict(_prequery)
+    affected = SQL("SELECT {0} FROM {1} WHERE {3} UNION SELECT {0} FROM {2} WHERE {3}").format(keys, tbl, curtbl, qstr)
+    # The affected keys that still have a version to show
+    kept = SQL("SELECT {0} FROM {1} WHERE ({0}) IN (SELECT {0} FROM {1} WHERE {2}) AND {3}").format(keys, tbl, qstr, pqstr)
+    kept_values = values + pqvalues
+    with DelayCommit(db):
+        # Current rows that won't be replaced below have been deleted from the history
+        # (or only have versions awaiting approval), so we leave a tombstone for changed_since
+        db._execute(
+            SQL(
+                "INSERT INTO {0} ({1}, published) SELECT {1}, published FROM {2} WHERE ({1}) IN ({3}) AND ({1}) NOT IN ({4}) "
+                "ON CONFLICT ({1}) DO UPDATE SET changed = DEFAULT, changed_at = DEFAULT, "
+                "published = {0}.published OR EXCLUDED.published"
+            ).format(tombs, keys, curtbl, affected, kept),
+            values + values + kept_values,
+        )
+        db._execute(
+            SQL("DELETE FROM {0} WHERE ({1}) IN ({2}) AND ({1}) NOT IN ({3})").format(curtbl, keys, affected, kept),
+            values + values + kept_values,
+        )
+        # We update rows in place rather than deleting and reinserting them, so that concurrent refreshes
+        # of the same rows wait for each other rather than failing on the unique index, and so that
+        # rows remember whether they have been public
+        updates = SQL(", ").join(
+            SQL("{0} = EXCLUDED.{0}").format(IdentifierWrapper(col)) for col in ["id"] + table.search_cols
+        )
+        db._execute(
+            SQL(
+                "INSERT INTO {0} ({1}, published) SELECT DISTINCT ON ({2}) {1}, {7} FROM {3} "
+                "WHERE ({2}) IN (SELECT {2} FROM {3} WHERE {4}) AND {5} ORDER BY {2}, id DESC "
+                "ON CONFLICT ({2}) DO UPDATE SET {6}, changed = DEFAULT, changed_at = DEFAULT, "
+                "published = {0}.published OR EXCLUDED.published"
+            ).format(curtbl, cols, keys, tbl, qstr, pqstr, updates, _public_condition[name]),
+            values + pqvalues,
+        )
+        if name == "seminars" and _current_table_exists("talks"):
+            # Talks become public when their series does
+            db._execute(
+                SQL("UPDATE talks_current SET published = TRUE WHERE NOT published AND seminar_id IN ({0}) AND {1}").format(
+                    kept, _public_condition["talks"]
+                ),
+                kept_values,
+            )
+        # Rows that have come back (for example, a series recreated with the same shortname) are no longer removed
+        db._execute(
+            SQL("DELETE FROM {0} WHERE ({1}) IN ({2})").format(tombs, keys, kept),
+            kept_values,
+        )
+        bump_generation(name)
+
+
+def build_current_tables():
+    """
+    Creates seminars_current and talks_current from scratch, as well as the tables
+    seminars_tombstones and talks_tombstones if they don't exist (existing tombstones are kept).
+
+    Rerun this after adding columns to db.seminars or db.talks.
+    """
+    with DelayCommit(db):
+        # Rows get a new value of changed whenever refresh_current rewrites them; see changed_since
+        db._execute(SQL("CREATE SEQUENCE IF NOT EXISTS current_changes"))
+        for name, keys in current_keys.items():
+            curtbl = IdentifierWrapper(name + "_current")
+            tombs = IdentifierWrapper(name + "_tombstones")
+            keycols = SQL(", ").join(map(IdentifierWrapper, keys))
+            db._execute(SQL("DROP TABLE IF EXISTS {0}").format(curtbl))
+            db._execute(SQL("CREATE TABLE {0} (LIKE {1})").format(curtbl, IdentifierWrapper(name)))
+            cur = db._execute(SQL("SELECT to_regclass(%s)"), [name + "_tombstones"])
+            new_tombs = cur.fetchone()[0] is None
+            if new_tombs:
+                db._execute(SQL("CREATE TABLE {0} AS SELECT {1} FROM {2} WITH NO DATA").format(
+                    tombs, keycols, IdentifierWrapper(name)))
+            else:
+                # Tombstones from before rows tracked whether they were public aren't reported
+                db._execute(SQL("ALTER TABLE {0} ADD COLUMN IF NOT EXISTS published boolean NOT NULL DEFAULT FALSE").format(tombs))
+            # changed_at is the time the counter was drawn, rather than the start of the transaction
+            for tbl in ([curtbl, tombs] if new_tombs else [curtbl]):
+                db._execute(
+                    SQL("ALTER TABLE {0} ADD COLUMN changed bigint NOT NULL DEFAULT nextval('current_changes'), "
+                        "ADD COLUMN changed_at timestamptz NOT NULL DEFAULT clock_timestamp(), "
+                        "ADD COLUMN published boolean NOT NULL DEFAULT FALSE").format(tbl)
+                )
+                db._execute(SQL("CREATE INDEX ON {0} (changed)").format(tbl))
+                db._execute(SQL("CREATE UNIQUE INDEX ON {0} ({1})").format(tbl, keycols))
+            for index in current_indexes[name]:
+                db._execute(
+                    SQL("CREATE INDEX ON {0} ({1})").format(
+                        curtbl, SQL(", ").join(map(IdentifierWrapper, index))
+                    )
+                )
+        for name in current_keys:
+            refresh_current(getattr(db, name))
+
+
+def changes_until():
+    """
+    The time up to which changed_since reports changes: CHANGES_LAG before the current database time.
+
+    Values of the change counter are drawn before the transaction writing them commits, so a row may become
+    visible after rows with larger values.  Since a row's ``changed_at`` is set when its value is drawn,
+    all rows with smaller values were drawn earlier, and have committed as long as the transactions
+    of ``refresh_current`` take less than CHANGES_LAG.  Compute this once and pass it to every
+    call of changed_since whose results are combined, so that they agree.
+    """
+    cur = db._execute(SQL("SELECT clock_timestamp() - %s"), [CHANGES_LAG])
+    return cur.fetchone()[0]
+
+
+def changed_since(table, cols, since=None, since_time=None, limit=None, until=None):
+    """
+    The current rows of ``table`` that have changed since a given point, in the order of their changes.
+
+    Each rewrite of a row by ``refresh_current`` (including marking it as deleted) assigns it
+    a new value of the ``changed`` counter, which is shared between seminars_current and talks_current.
+    Rows removed from the history altogether are represented by their tombstones, which get a value
+    of the counter in the same way.
+
+    INPUT:
+
+    - ``table`` -- db.seminars or db.talks
+    - ``cols`` -- the columns to return
+    - ``since`` -- a value of the change counter; only rows changed after it are returned
+    - ``since_time`` -- a datetime; only rows edited after it are returned (note that deleting a row doesn't change its edit time)
+    - ``limit`` -- the maximum number of rows to return
+    - ``until`` -- a datetime, as returned by changes_until (the default); only rows changed before it are returned
+
+    OUTPUT:
+
+    A list of pairs (changed, rec), where rec is a dictionary with keys ``cols``, or for tombstones
+    a dictionary with the key columns, ``published`` and ``deleted`` set to True.
+    Returns None if the current tables have not been built.
+    """
+    name = table.search_table
+    if not _current_table_exists(name):
+        return None
+    if until is None:
+        until = changes_until()
+    keys = current_keys[name]
+    ans = []
+    for tombstones in [False, True]:
+        if tombstones:
+            tbl, tcols, edit_col = name + "_tombstones", keys + ["published"], "changed_at"
+        else:
+            tbl, tcols, edit_col = name + "_current", cols, "edited_at"
+        conditions, values = [SQL("changed_at < %s")], [until]
+        if since is not None:
+            conditions.append(SQL("changed > %s"))
+            values.append(since)
+        if since_time is not None:
+            # Tombstones have no edit time, so we use the time they were created
+            conditions.append(SQL("{0} > %s").format(IdentifierWrapper(edit_col)))
+            values.append(since_time)
+        selecter = SQL("SELECT changed, {0} FROM {1} WHERE {2} ORDER BY changed").format(
+            SQL(", ").join(map(IdentifierWrapper, tcols)),
+            IdentifierWrapper(tbl),
+            SQL(" AND ").join(conditions),
+        )
+        if limit is not None:
+            selecter = selecter + SQL(" LIMIT %s")
+            values.append(limit)
+        cur = db._execute(selecter, values)
+        for rec in cur:
+            rec_dict = dict(zip(tcols, rec[1:]))
+            if tombstones:
+                rec_dict["deleted"] = True
+            ans.append((rec[0], rec_dict))
+    ans.sort(key=lambda x: x[0])
+    return ans[:limit]
+
+
+def count_distinct(table, counter, query={}, include_deleted=False, include_pending=False, versioned=False):
     query = dict(query)
     if not include_deleted:
         query["deleted"] = {"$or": [False, {"$exists": False}]}
     cols = SQL(", ").join(map(IdentifierWrapper, table.search_cols))
-    tbl = IdentifierWrapper(table.search_table)
+    cur_table = current_table(table, include_pending, versioned)
+    if cur_table is None:
+        tbl = IdentifierWrapper(table.search_table)
+    else:
+        tbl = IdentifierWrapper(cur_table)
+        counter = _current_counter
     qstr, values = table._build_query(query, sort=[])
+    if not include_pending and cur_table is None:
+        pqstr, pqvalues = table._parse_dict(_prequery)
+        tbl = tbl + SQL(" WHERE {0}").format(pqstr)
+        values = pqvalues + values
     counter = counter.format(cols, tbl, qstr)
     cur = table._execute(counter, values)
     return int(cur.fetchone()[0])
 
 
+def facet_counts_distinct(table, selecter, col, query={}, array=False, include_deleted=False, include_pending=False, versioned=False):
+    """
+    Counts the current rows matching ``query`` according to their value of ``col``, using a single GROUP BY query.
+
+    INPUT:
+
+    - ``table`` -- a search table, such as db.seminars or db.talks
+    - ``selecter`` -- an SQL object selecting distinct entries
+    - ``col`` -- the column to group on
+    - ``array`` -- if True, ``col`` is an array column and each entry is counted separately
+
+    OUTPUT:
+
+    A Counter with keys the values of ``col``
+    """
+    query = dict(query)
+    if not include_deleted:
+        query["deleted"] = {"$or": [False, {"$exists": False}]}
+    all_cols = SQL(", ").join(map(IdentifierWrapper, ["id"] + table.search_cols))
+    cur_table = current_table(table, include_pending, versioned)
+    if cur_table is None:
+        tbl = IdentifierWrapper(table.search_table)
+    else:
+        tbl = IdentifierWrapper(cur_table)
+        selecter = _current_selecter
+    qstr, values = table._build_query(query, sort=[])
+    if not include_pending and cur_table is None:
+        pqstr, pqvalues = table._parse_dict(_prequery)
+        tbl = tbl + SQL(" WHERE {0}").format(pqstr)
+        values = pqvalues + values
+    val = (SQL("unnest({0})") if array else SQL("{0}")).format(IdentifierWrapper(col))
+    inner = selecter.format(val, all_cols, tbl, qstr)
+    cur = table._execute(SQL("SELECT val, COUNT(*) FROM ({0}) facets(val) GROUP BY val").format(inner), values)
+    return Counter({val: int(cnt) for (val, cnt) in cur})
+
+
+def last_edit_distinct(table, selecter, query={}, include_deleted=False, include_pending=False, versioned=False, extra=None):
+    """
+    The most recent ``edited_at`` among the current rows matching ``query``, together with the number of such rows.
+
+    Since deleting a row doesn't change its ``edited_at``, the pair changes whenever the set of matching rows does.
+
+    INPUT:
+
+    - ``table`` -- a search table, such as db.seminars or db.talks
+    - ``selecter`` -- an SQL object selecting distinct entries
+    - ``extra`` -- optionally, a pair (an SQL aggregate over the matching rows, values for its placeholders)
+
+    OUTPUT:
+
+    A pair (a datetime or None, an integer), followed by the value of ``extra`` if given
+    """
+    query = dict(query)
+    if not include_deleted:
+        query["deleted"] = {"$or": [False, {"$exists": False}]}
+    all_cols = SQL(", ").join(map(IdentifierWrapper, ["id"] + table.search_cols))
+    cur_table = current_table(table, include_pending, versioned)
+    if cur_table is None:
+        tbl = IdentifierWrapper(table.search_table)
+    else:
+        tbl = IdentifierWrapper(cur_table)
+        selecter = _current_selecter
+    qstr, values = table._build_query(query, sort=[])
+    if not include_pending and cur_table is None:
+        pqstr, pqvalues = table._parse_dict(_prequery)
+        tbl = tbl + SQL(" WHERE {0}").format(pqstr)
+        values = pqvalues + values
+    cols = SQL("MAX({0}), COUNT(*)").format(IdentifierWrapper("edited_at"))
+    if extra is not None:
+        # The selected columns come before any other placeholders
+        cols = cols + SQL(", ") + extra[0]
+        values = list(extra[1]) + values
+    cur = table._execute(selecter.format(cols, all_cols, tbl, qstr), values)
+    rec = cur.fetchone()
+    return (rec[0], int(rec[1])) + tuple(rec[2:])
+
+
 def max_distinct(table, maxer, col, constraint={}, include_deleted=False):
     # Note that this will return None for the max of an empty set
     constraint = dict(constraint)
@@ -367,11 +705,50 @@ def max_distinct(table, maxer, col, constraint={}, include_deleted=False):
     cols = SQL(", ").join(map(IdentifierWrapper, table.search_cols))
     tbl = IdentifierWrapper(table.search_table)
     qstr, values = table._build_query(constraint, sort=[])
-    maxer = maxer.format(IdentifierWrapper(col), cols, tbl, qstr)
+    cur_table = current_table(table)
+    if cur_table is not None:
+        # The current table skips versions awaiting approval, which still need to be counted
+        # (for example when choosing the next seminar_ctr), so we add the few of them from the history
+        pqstr, pqvalues = table._parse_dict(_prequery)
+        maxer = SQL(
+            "SELECT GREATEST((SELECT MAX({0}) FROM {1}{3}), (SELECT MAX({0}) FROM (SELECT {4} FROM {2} WHERE NOT ({5})) tmp{3}))"
+        ).format(IdentifierWrapper(col), IdentifierWrapper(cur_table), tbl, qstr, cols, pqstr)
+        values = values + pqvalues + values
+    else:
+        maxer = maxer.format(IdentifierWrapper(col), cols, tbl, qstr)
     cur = table._execute(maxer, values)
     return cur.fetchone()[0]
 
 
+# Used to give each server side cursor opened by _streamed a distinct name
+_stream_counter = itertools.count()
+
+
+def _streamed(statement, values, iterate):
+    # Yields from iterate(cur), where cur is a server side cursor executing statement, so that rows are
+    # fetched from the database as they're consumed.  Unlike those from _execute(buffered=True), the cursor
+    # isn't a withhold cursor, so it only lives in the current transaction: we keep that transaction open,
+    # deferring commits by other queries, until the generator is exhausted or closed, and then commit.
+    # Nothing is executed until the first result is requested, so an unused generator holds nothing open.
+    with DelayCommit(db):
+        cur = db.conn.cursor("stream%d" % next(_stream_counter))
+        cur.itersize = 2000
+        try:
+            cur.execute(statement, values)
+            results = iterate(cur)
+            try:
+                for rec in results:
+                    yield rec
+            finally:
+                results.close()
+        except GeneratorExit:
+            # Stopping early isn't an error, so the transaction is still committed
+            pass
+        finally:
+            if not cur.closed:
+                cur.close()
+
+
 def search_distinct(
     table,
     selecter,
@@ -386,11 +763,16 @@ def search_distinct(
     include_deleted=False,
     include_pending=False,
     more=False,
+    versioned=False,
+    current_selecter=None,
+    exact_count=True,
+    lazy=False,
+    after=None,
 ):
     """
     Replacement for db.*.search to account for versioning, return Web* objects.
 
-    Doesn't support split_ors, raw or extra tables.  Always computes count.
+    Doesn't support split_ors, raw or extra tables.  Computes a count only when ``info`` is provided.
 
     INPUT:
 
@@ -398,6 +780,16 @@ def search_distinct(
     - ``counter`` -- an SQL object counting distinct entries
     - ``selecter`` -- an SQL objecting selecting distinct entries
     - ``iterator`` -- an iterator taking the same arguments as ``_search_iterator``
+    - ``versioned`` -- if True, scan the version history even when a current table is available (for auditing)
+    - ``current_selecter`` -- replacement for ``selecter`` used when searching the current table
+    - ``exact_count`` -- if False and ``info`` is provided, only determine whether there are more results
+      than shown (``info["number"]`` is then a lower bound), rather than counting them all
+    - ``lazy`` -- if True (and ``info`` is not provided), return a generator that constructs results
+      as they come off a server side cursor, rather than a list.  The cursor and its transaction are closed
+      when the generator is exhausted or closed, so callers that stop early should call its ``close`` method;
+      queries made while consuming it are committed at that point.
+    - ``after`` -- for keyset paging, a triple (columns, values, descending): only records coming strictly after
+      ``values`` in the order given by ``columns`` (before, if ``descending``) are returned
     """
     if offset < 0:
         raise ValueError("Offset cannot be negative")
@@ -406,12 +798,14 @@ def search_distinct(
         query["deleted"] = {"$or": [False, {"$exists": False}]}
     all_cols = SQL(", ").join(map(IdentifierWrapper, ["id"] + table.search_cols))
     search_cols, extra_cols = table._parse_projection(projection)
-    tbl = IdentifierWrapper(table.search_table)
-    if limit is None:
-        qstr, values = table._build_query(query, sort=sort)
+    cur_table = current_table(table, include_pending, versioned)
+    if cur_table is None:
+        tbl = IdentifierWrapper(table.search_table)
     else:
-        qstr, values = table._build_query(query, limit, offset, sort)
-    prequery = {} if include_pending else {'$or': [{'display': True}, {'by_api': False}]}
+        tbl = IdentifierWrapper(cur_table)
+        selecter = _current_selecter if current_selecter is None else current_selecter
+    prequery = {} if include_pending or cur_table is not None else _prequery
+    prevalues = []
     if prequery:
         # We filter the records before finding the most recent (normal queries filter after finding the most recent)
         # This is mainly used for setting display=False or display=True
@@ -419,7 +813,26 @@ def search_distinct(
         pqstr, pqvalues = table._parse_dict(prequery)
         if pqstr is not None:
             tbl = tbl + SQL(" WHERE {0}").format(pqstr)
-            values = pqvalues + values
+            prevalues = pqvalues
+    if after is not None:
+        after_cols, after_values, descending = after
+        if cur_table is None:
+            # The condition applies to the most recent versions, so it must go in the query
+            op = "$lt" if descending else "$gt"
+            clauses = []
+            for i, col in enumerate(after_cols):
+                clause = dict(zip(after_cols[:i], after_values[:i]))
+                clause[col] = {op: after_values[i]}
+                clauses.append(clause)
+            query = {"$and": [query, {"$or": clauses}]}
+        else:
+            # A row comparison, so that an index on these columns gives a range scan
+            tbl = tbl + SQL(" WHERE ({0}) {1} ({2})").format(
+                SQL(", ").join(map(IdentifierWrapper, after_cols)),
+                SQL("<" if descending else ">"),
+                SQL(", ").join([Placeholder()] * len(after_cols)),
+            )
+            prevalues = prevalues + list(after_values)
     if more is not False: # might empty dictionary
         more, moreval = table._parse_dict(more)
         if more is None:
@@ -428,55 +841,77 @@ def search_distinct(
 
         cols = SQL(", ").join(list(map(IdentifierWrapper, search_cols + extra_cols)) + [more])
         extra_cols = extra_cols + ("more",)
-        values = moreval + values
+        prevalues = moreval + prevalues
     else:
         cols = SQL(", ").join(map(IdentifierWrapper, search_cols + extra_cols))
-    fselecter = selecter.format(cols, all_cols, tbl, qstr)
-    cur = table._execute(
-        fselecter,
-        values,
-        buffered=False,
-        slow_note=(
-            table.search_table,
-            "analyze",
-            query,
-            repr(projection),
-            limit,
-            offset,
-        ),
-    )
-    results = iterator(cur, search_cols, extra_cols, projection)
-    if info is not None:
-        # caller is requesting count data
-        nres = count_distinct(table, counter, query)
+    # When the caller wants an exact count for a page of results, we get it from a window function
+    # in the same query.  The extra column comes last, so the iterators ignore it.
+    window = info is not None and limit is not None and exact_count
+    if window:
+        cols = cols + SQL(", COUNT(*) OVER ()")
+    # Otherwise we fetch one extra row to find out whether there are more results
+    fetch = limit if (limit is None or exact_count) else limit + 1
+
+    def statement(offset):
         if limit is None:
-            info["number"] = nres
-            return results
-        if offset >= nres > 0:
-            # We're passing in an info dictionary, so this is a front end query,
-            # and the user has requested a start location larger than the number
-            # of results.  We adjust the results to be the last page instead.
-            offset -= (1 + (offset - nres) / limit) * limit
-            if offset < 0:
-                offset = 0
-            return search_distinct(
-                table,
-                selecter,
-                counter,
-                iterator,
+            qstr, values = table._build_query(query, sort=sort)
+        else:
+            qstr, values = table._build_query(query, fetch, offset, sort)
+        return selecter.format(cols, all_cols, tbl, qstr), prevalues + values
+
+    def execute(offset):
+        fselecter, values = statement(offset)
+        return table._execute(
+            fselecter,
+            values,
+            slow_note=(
+                table.search_table,
+                "analyze",
                 query,
-                projection,
+                repr(projection),
                 limit,
                 offset,
-                sort,
-                info,
-            )
+            ),
+        )
+
+    if lazy and info is None:
+        fselecter, values = statement(offset)
+        return _streamed(fselecter, values, lambda cur: iterator(cur, search_cols, extra_cols, projection))
+    cur = execute(offset)
+    if info is not None:
+        # caller is requesting count data
+        if limit is None:
+            res = list(iterator(cur, search_cols, extra_cols, projection))
+            info["number"] = len(res)
+            return res
+        if not exact_count:
+            res = list(iterator(cur, search_cols, extra_cols, projection))
+            nres = offset + len(res)
+            res = res[:limit]
+        else:
+            if cur.rowcount > 0:
+                nres = int(cur.fetchone()[-1])
+                cur.scroll(0, mode="absolute")
+            elif offset > 0:
+                nres = count_distinct(table, counter, query, include_deleted=True, include_pending=include_pending, versioned=versioned)
+                if offset >= nres > 0:
+                    # We're passing in an info dictionary, so this is a front end query,
+                    # and the user has requested a start location larger than the number
+                    # of results.  We adjust the results to be the last page instead.
+                    offset -= (1 + (offset - nres) // limit) * limit
+                    if offset < 0:
+                        offset = 0
+                    cur = execute(offset)
+            else:
+                nres = 0
+            res = list(iterator(cur, search_cols, extra_cols, projection))
         info["query"] = dict(query)
         info["number"] = nres
         info["count"] = limit
         info["start"] = offset
-        info["exact_count"] = True
-    res = list(results)
+        info["exact_count"] = exact_count
+        return res
+    res = list(iterator(cur, search_cols, extra_cols, projection))
     return res
 
 
@@ -490,6 +925,7 @@ def lucky_distinct(
     sort=[],
     include_deleted=False,
     include_pending=False,
+    versioned=False,
 ):
     query = dict(query)
     if not include_deleted:
@@ -498,8 +934,13 @@ def lucky_distinct(
     search_cols, extra_cols = table._parse_projection(projection)
     cols = SQL(", ").join(map(IdentifierWrapper, search_cols + extra_cols))
     qstr, values = table._build_query(query, 1, offset, sort=sort)
-    tbl = table._get_table_clause(extra_cols)
-    prequery = {} if include_pending else {'$or': [{'display': True}, {'by_api': False}]}
+    cur_table = current_table(table, include_pending, versioned)
+    if cur_table is None:
+        tbl = table._get_table_clause(extra_cols)
+    else:
+        tbl = IdentifierWrapper(cur_table)
+        selecter = _current_selecter
+    prequery = {} if include_pending or cur_table is not None else _prequery
     if prequery:
         # We filter the records before finding the most recent (normal queries filter after finding the most recent)
         # This is mainly used for setting display=False or display=True
@@ -757,21 +1198,86 @@ class Toggle(SearchBox):
         return '<span style="display: inline-block">%s</span>' % (main,)
 
 
-def ics_file(talks, filename, user=None):
+def feed_validators(stamps, *extra):
+    """
+    Computes an ETag and a Last-Modified time for a feed, without constructing its contents.
+
+    INPUT:
+
+    - ``stamps`` -- a list of tuples as returned by ``talks_last_edit`` and ``seminars_last_edit``:
+      a last edit time and a number of rows, possibly followed by other times at which the content changed
+    - ``extra`` -- anything else the content of the feed depends on, such as the viewer
+
+    OUTPUT:
+
+    A pair (etag, last_modified), where last_modified is None if there are no rows
+    """
+    times = [t if t.tzinfo else pytz.UTC.localize(t) for stamp in stamps for t in stamp if isinstance(t, datetime)]
+    last_modified = max(times).replace(microsecond=0) if times else None
+    etag = hashlib.sha1(repr((stamps, extra)).encode("utf-8")).hexdigest()
+    return etag, last_modified
+
+
+def not_modified(etag, last_modified):
+    """
+    Returns a 304 response if the request's If-None-Match or If-Modified-Since header shows
+    that the client already has the current version, and None otherwise.
+    """
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    elif request.if_modified_since and last_modified is not None:
+        fresh = last_modified <= request.if_modified_since
+    else:
+        fresh = False
+    if fresh:
+        response = Response(status=304)
+        response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        return response
+
+
+def ics_file(talks, filename, user=None, etag=None, last_modified=None):
+    """
+    Streams a calendar file, serializing one event at a time.
+
+    INPUT:
+
+    - ``talks`` -- an iterable of WebTalk objects; pass a lazy search so that the first bytes are sent
+      before the query has been fully read
+    - ``filename`` -- the name of the downloaded file
+    - ``user`` -- the user whose access determines which links are included (defaults to the current user)
+    - ``etag``, ``last_modified`` -- validators for the feed, as computed by ``feed_validators``
+    """
     if user is None: user = current_user
     cal = Calendar()
     cal.add("VERSION", "2.0")
     cal.add("PRODID", topdomain())
     cal.add("CALSCALE", "GREGORIAN")
     cal.add("X-WR-CALNAME", topdomain())
+    # An empty calendar serializes as the header followed by the closing line
+    footer = b"END:VCALENDAR\r\n"
+    header = cal.to_ical()[:-len(footer)]
 
-    for talk in talks:
-        cal.add_component(talk.event(user=user))
-
-    bIO = BytesIO()
-    bIO.write(cal.to_ical())
-    bIO.seek(0)
-    return send_file(bIO, download_name=filename, as_attachment=True)
+    def generate():
+        try:
+            yield header
+            for talk in talks:
+                yield talk.ics_event(user)
+            yield footer
+        finally:
+            # Releases the database cursor behind a lazy search if the client disconnects early
+            close = getattr(talks, "close", None)
+            if close is not None:
+                close()
+
+    response = Response(stream_with_context(generate()), mimetype="text/calendar")
+    response.headers["Content-Disposition"] = 'attachment; filename="%s"' % filename
+    if etag is not None:
+        response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
 
 def num_columns(labels):
     if not labels:
@@ -845,9 +1351,10 @@ whitelisted_cols = [
 ]
 
 class APIError(Exception):
-    def __init__(self, error={}, status=400):
+    def __init__(self, error={}, status=400, headers=None):
         self.error = error
         self.status = status
+        self.headers = headers
 
 @lru_cache(maxsize=None)
 def sanitized_table(name):